@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+#######################################################################################################
+# Author: false-wheel
+#
+# License: http://www.gnu.org/licenses/gpl-3.0.en.html
+#
+# Purpose: Benchmark ny-vax-alert-pub.py offline.  A local stand-in for the vaccine API replays recorded
+# or synthetic providerList payloads, changing availability at a set rate, and a local smtp sink takes
+# the alerts.  Reports throughput, per-poll latency and peak memory for each subscriber count.
+#
+# Usage: py -O ny-vax-alert-bench.py --providers 2000 --subscribers 100,1000,10000
+#        py -O ny-vax-alert-bench.py --payload recorded-1.json --payload recorded-2.json
+#        py -O ny-vax-alert-bench.py --output baseline.json
+#        py -O ny-vax-alert-bench.py --baseline baseline.json    # exits 1 on a regression
+#        py -O ny-vax-alert-bench.py --subscribers 100 --startup-runs 20   # mostly cron style startup time
+#######################################################################################################
+
+
+#######################################################################################################
+import argparse
+import hashlib
+import http.server
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+
+#######################################################################################################
+# load ny-vax-alert-pub.py as a module - the dashes keep it from being imported by name
+def load_vax_alert():
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ny-vax-alert-pub.py')
+  spec = importlib.util.spec_from_file_location('ny_vax_alert_pub', path)
+  vax_alert = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(vax_alert)
+  return vax_alert
+
+vax_alert = load_vax_alert()
+
+
+#######################################################################################################
+# the NY api as the watcher sees it, pointed at the local stand-in
+def create_bench_vaccine_api(url, stream=False):
+  return {
+    'url': url,
+    'provider_id_field': 'providerId',
+    'available_appointments_field': 'availableAppointments',
+    'available_appointments_value': 'Y',
+    'provider_name_field': 'providerName',
+    'feed_adapter': 'ny',
+    'stream': stream
+  }
+
+
+#######################################################################################################
+# synthetic providerList in the NY format, provider ids start at 1000 like the real ones
+def create_provider_list(provider_count, rng):
+  brands = ['Pfizer', 'Moderna', 'Johnson & Johnson']
+  return [{
+    'providerId': 1000 + i,
+    'providerName': 'Bench Site ' + str(i),
+    'vaccineBrand': rng.choice(brands),
+    'address': 'Town ' + str(i % 500) + ', NY',
+    'availableAppointments': 'Y' if rng.random() < 0.2 else 'N'
+  } for i in range(provider_count)]
+
+
+#######################################################################################################
+# flip the availability of change_rate of the providers
+def change_provider_list(provider_list, change_rate, rng):
+  for provider in rng.sample(provider_list, int(len(provider_list) * change_rate)):
+    provider['availableAppointments'] = 'N' if provider['availableAppointments'] == 'Y' else 'Y'
+
+
+#######################################################################################################
+# stand-in vaccine api - every GET serves the next payload, either the next recorded one or the
+# synthetic list after a round of changes. sends an ETag, so unchanged payloads get a 304
+class MockVaccineApiHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'    # keep-alive, like the real api
+
+  def do_GET(self):
+    body = self.server.next_body()
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    if self.headers.get('If-None-Match') == etag:
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('ETag', etag)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+#######################################################################################################
+# run the stand-in vaccine api until the process is stopped, sending its port back through conn
+# recorded_payloads (list of response bodies) are replayed in a loop, otherwise a synthetic list of
+# provider_count providers is served with change_rate of them flipping on every request
+def serve_mock_vaccine_api(conn, recorded_payloads, provider_count, change_rate, seed):
+  rng = random.Random(seed)
+  provider_list = create_provider_list(provider_count, rng)
+  lock = threading.Lock()
+  request_count = [0]
+
+  def next_body():
+    with lock:
+      request_count[0] += 1
+      if recorded_payloads:
+        return recorded_payloads[(request_count[0] - 1) % len(recorded_payloads)]
+      if request_count[0] > 1:
+        change_provider_list(provider_list, change_rate, rng)
+      return json.dumps({'providerList': provider_list, 'lastUpdated': time.strftime('%m/%d/%Y, %I:%M:%S %p')}).encode('utf-8')
+
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MockVaccineApiHandler)
+  server.daemon_threads = True
+  server.next_body = next_body
+  conn.send(server.server_address[1])
+  server.serve_forever()
+
+
+#######################################################################################################
+# start the stand-in vaccine api in its own process, so building its payloads doesn't count against the
+# latency and memory we measure. returns (process, url)
+def start_mock_vaccine_api(recorded_payloads=None, provider_count=1000, change_rate=0.01, seed=0):
+  parent_conn, child_conn = multiprocessing.Pipe()
+  process = multiprocessing.Process(target=serve_mock_vaccine_api, args=(child_conn, recorded_payloads, provider_count, change_rate, seed), daemon=True)
+  process.start()
+  return process, 'http://127.0.0.1:' + str(parent_conn.recv()) + '/api/list-providers'
+
+
+#######################################################################################################
+# subscribers each wanting a few random providers
+def create_subscribers(subscriber_count, provider_ids, vaccine_api, rng):
+  return [{
+    'name': 'subscriber-' + str(i),
+    'vaccine_api': vaccine_api,
+    'desired_provider_id_values': rng.sample(provider_ids, min(5, len(provider_ids))),
+    'msg': {'to': 'subscriber-' + str(i) + '@localhost', 'subject': 'Alert - NY vaccine available'}
+  } for i in range(subscriber_count)]
+
+
+#######################################################################################################
+# latency summary in milliseconds
+def summarize_latencies(latencies):
+  latencies = sorted(latencies)
+  return {
+    'p50_ms': round(1000 * latencies[len(latencies) // 2], 3),
+    'p95_ms': round(1000 * latencies[int(len(latencies) * 0.95)], 3),
+    'max_ms': round(1000 * latencies[-1], 3),
+    'mean_ms': round(1000 * statistics.mean(latencies), 3)
+  }
+
+
+#######################################################################################################
+# run fn polls times, timing each call and tracking peak memory
+def measure(fn, polls):
+  latencies = []
+  tracemalloc.start()
+  started = time.perf_counter()
+  for i in range(polls):
+    poll_started = time.perf_counter()
+    fn()
+    latencies.append(time.perf_counter() - poll_started)
+  elapsed = time.perf_counter() - started
+  peak_memory = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  result = summarize_latencies(latencies)
+  result['polls_per_second'] = round(polls / elapsed, 1)
+  result['peak_memory_kb'] = round(peak_memory / 1024, 1)
+  return result
+
+
+#######################################################################################################
+# fetch + check of one subscriber's providers, the way the single-subscriber watcher polls
+def bench_check(vaccine_api, provider_ids, polls, rng):
+  desired_provider_id_values = rng.sample(provider_ids, min(5, len(provider_ids)))
+  return measure(lambda: vax_alert.check_vaccine_availability(vaccine_api, desired_provider_id_values), polls)
+
+
+#######################################################################################################
+# fetch + diff + indexed match for subscriber_count subscribers, the way the async watcher polls
+def bench_match(vaccine_api, provider_ids, subscriber_count, polls, rng):
+  subscription_index = vax_alert.build_subscription_index(create_subscribers(subscriber_count, provider_ids, vaccine_api, rng))
+  snapshot = vax_alert.create_availability_snapshot()
+  match_count = [0]
+
+  def poll():
+    is_fetched, opened_provider_list, closed_provider_list = vax_alert.fetch_availability_changes(vaccine_api, snapshot)
+    match_count[0] += len(vax_alert.match_subscriptions(subscription_index, opened_provider_list))
+
+  result = measure(poll, polls)
+  result['matches'] = match_count[0]
+  return result
+
+
+#######################################################################################################
+# queue subscriber_count alerts through the notification dispatcher into a local smtp sink
+def bench_notify(subscriber_count, workers):
+  sink = vax_alert.start_smtp_sink()
+  smtp = {'mail_user': 'bench@localhost', 'mail_password': '', 'smtp_api_url': '127.0.0.1', 'smtp_api_port': sink.server_address[1], 'smtp_starttls': False}
+  dispatcher = vax_alert.create_notification_dispatcher(smtp, workers=workers, max_sends_per_second=1000000.0)
+  bodies = ['NY vaccine available!\nBench Site ' + str(i) + '\n' for i in range(10)]
+
+  started = time.perf_counter()
+  for i in range(subscriber_count):
+    vax_alert.queue_notification(dispatcher, 'subscriber-' + str(i) + '@localhost', 'Alert - NY vaccine available', bodies[i % len(bodies)])
+  vax_alert.close_notification_dispatcher(dispatcher)
+  elapsed = time.perf_counter() - started
+  sink.shutdown()
+  return {
+    'notifications_per_second': round(subscriber_count / elapsed, 1),
+    'mails_sent': sink.message_count,
+    'recipients_delivered': sink.recipient_count
+  }
+
+
+#######################################################################################################
+# cold start cost of a cron style run, each in a fresh interpreter: the bare interpreter, importing the
+# script, and a --once check against the stand-in that finds nothing to alert about
+def bench_startup(url, runs):
+  script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ny-vax-alert-pub.py')
+  import_code = ('import importlib.util; spec = importlib.util.spec_from_file_location("ny_vax_alert_pub", ' + repr(script_path) + '); '
+                 'spec.loader.exec_module(importlib.util.module_from_spec(spec))')
+  with tempfile.TemporaryDirectory() as temp_path:
+    config_path = os.path.join(temp_path, 'bench-config.json')
+    with open(config_path, 'w') as config_file:
+      json.dump({
+        'vaccine_apis': {'bench': {'url': url, 'feed_adapter': 'ny'}},
+        'smtp': {'mail_user': 'bench@localhost', 'mail_password': '', 'smtp_api_url': '127.0.0.1', 'smtp_api_port': 25},
+        'metrics_dump_frequency': 0,
+        'sent_log_path': os.path.join(temp_path, 'bench-sent.log'),
+        'subscribers': [{'name': 'bench', 'to': 'bench@localhost', 'desired_provider_id_values': [0]}]
+      }, config_file)
+
+    commands = {
+      'python': [sys.executable, '-O', '-c', 'pass'],
+      'import': [sys.executable, '-O', '-c', import_code],
+      'once': [sys.executable, '-O', script_path, '--once', config_path]
+    }
+    result = {}
+    for name, command in commands.items():
+      latencies = []
+      for i in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        latencies.append(time.perf_counter() - started)
+      result[name + '_p50_ms'] = summarize_latencies(latencies)['p50_ms']
+  return result
+
+
+#######################################################################################################
+# compare against a baseline run, returns the list of regressions
+# a latency (or memory) more than tolerance above the baseline, or a throughput that much below, is a regression
+def find_regressions(results, baseline, tolerance):
+  regressions = []
+  for bench, result in results.items():
+    for key, value in result.items():
+      baseline_value = baseline.get(bench, {}).get(key)
+      if not isinstance(baseline_value, (int, float)) or not baseline_value:
+        continue
+      if key.endswith('_per_second'):
+        is_regression = value < baseline_value * (1.0 - tolerance)
+      elif key.endswith('_ms') or key.endswith('_kb'):
+        is_regression = value > baseline_value * (1.0 + tolerance)
+      else:
+        continue
+      if is_regression:
+        regressions.append(bench + ' ' + key + ': ' + str(baseline_value) + ' -> ' + str(value))
+  return regressions
+
+
+#######################################################################################################
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark ny-vax-alert-pub.py against a local stand-in vaccine API')
+  parser.add_argument('--providers', type=int, default=1000, help='providers in the synthetic payload')
+  parser.add_argument('--subscribers', default='100,1000,10000', help='comma separated subscriber counts to run')
+  parser.add_argument('--polls', type=int, default=50, help='polls per benchmark')
+  parser.add_argument('--change-rate', type=float, default=0.01, help='fraction of providers flipping availability per poll')
+  parser.add_argument('--payload', action='append', default=[], help='recorded api response to replay instead of the synthetic one (repeatable)')
+  parser.add_argument('--workers', type=int, default=2, help='notification dispatcher workers')
+  parser.add_argument('--stream', action='store_true', help='parse the provider list as it streams in')
+  parser.add_argument('--startup-runs', type=int, default=5, help='fresh interpreters to time startup over, 0 skips it')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='write the results to this json file')
+  parser.add_argument('--baseline', help='json results of an earlier run to check for regressions against')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='how much worse than the baseline counts as a regression')
+  args = parser.parse_args()
+
+  recorded_payloads = []
+  for path in args.payload:
+    with open(path, 'rb') as payload_file:
+      recorded_payloads.append(payload_file.read())
+  process, url = start_mock_vaccine_api(recorded_payloads, args.providers, args.change_rate, args.seed)
+
+  # provider ids to subscribe to, from whatever the stand-in serves
+  if recorded_payloads:
+    provider_ids = sorted(set(provider['providerId'] for payload in recorded_payloads for provider in json.loads(payload)['providerList']))
+  else:
+    provider_ids = list(range(1000, 1000 + args.providers))
+  rng = random.Random(args.seed)
+
+  # requests is only imported on first use - do that now, so the first measured poll doesn't pay for it
+  vax_alert.get_vaccine_api_session()
+
+  results = {}
+  results['check'] = bench_check(create_bench_vaccine_api(url + '?check', args.stream), provider_ids, args.polls, rng)
+  for subscriber_count in (int(count) for count in args.subscribers.split(',')):
+    results['match_' + str(subscriber_count)] = bench_match(create_bench_vaccine_api(url + '?match' + str(subscriber_count), args.stream), provider_ids, subscriber_count, args.polls, rng)
+    results['notify_' + str(subscriber_count)] = bench_notify(subscriber_count, args.workers)
+  if args.startup_runs:
+    results['startup'] = bench_startup(url + '?startup', args.startup_runs)
+  process.terminate()
+
+  for bench, result in results.items():
+    print(bench + ': ' + ' '.join(key + '=' + str(value) for key, value in result.items()))
+
+  if args.output:
+    with open(args.output, 'w') as output_file:
+      json.dump(results, output_file, indent=2)
+
+  if args.baseline:
+    with open(args.baseline) as baseline_file:
+      regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+    for regression in regressions:
+      print('Regression: ' + regression)
+    if regressions:
+      sys.exit(1)
+
+
+#######################################################################################################
+if __name__ == '__main__':
+  main()
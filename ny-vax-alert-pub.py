@@ -8,8 +8,9 @@
 # Purpose: Ping the NY vaccine site every N seconds, if the any of the sites you want are available, 
 # this will email you.  I recommend emailing your phone's SMS service - see https://resources.voyant.com/en/articles/3107728-sending-emails-to-sms-or-mms
 #
-# Usage: py -O ny-vax-alert-pub.py
-# Search for "CHANGE BEFORE USE" and edit as needed for your use case
+# Usage: py -O ny-vax-alert-pub.py [--daemon | --once | --report] [config.json]
+# Copy ny-vax-alert.example.json to ny-vax-alert.json and edit it for your use case, or search for
+# "CHANGE BEFORE USE" and edit as needed
 #
 # Built with Python 3.9.x
 # Install https://requests.readthedocs.io/en/master/
@@ -17,186 +18,3034 @@
 
 
 #######################################################################################################
+import argparse
+import array
+import codecs
+import contextlib
 import datetime
-from email.mime.text import MIMEText
+import hashlib
+import importlib
 import json
-import requests
-import smtplib
-import socket
-import subprocess
+import math
+import mmap
+import os
+import queue
+import random
+import signal
 import sys
+import threading
 import time
 import traceback
+import zlib
 
 
 #######################################################################################################
-# create message body
-def create_message(desired_provider_available_list, provider_name_field):
-  body_format = 'NY vaccine available! ({now})\n'
-  date_format = '%Y-%m-%d %H:%M'
-  now = datetime.datetime.now().strftime(date_format)
-  msg_body = body_format.format(now=now)
-  # add list of providers we found that match our desired provider list
-  for provider in  desired_provider_available_list:
-    msg_body += provider[provider_name_field] + '\n'
+# modules only some runs need - each is imported the first time something in it is used, so importing
+# this script, or a one-shot check that finds nothing, doesn't pay for them (smtp is only loaded to send)
+class LazyModule:
+  lock = threading.Lock()
+
+  def __init__(self, module_name):
+    self.module_name = module_name
+    self.loaded_module = None
+
+  # only called for attributes not found on the LazyModule itself, i.e. everything from the module
+  def __getattr__(self, attribute):
+    if self.loaded_module is None:
+      with LazyModule.lock:
+        if self.loaded_module is None:
+          self.loaded_module = importlib.import_module(self.module_name)
+    return getattr(self.loaded_module, attribute)
+
+asyncio = LazyModule('asyncio')
+futures = LazyModule('concurrent.futures')
+http_server = LazyModule('http.server')
+mime_text = LazyModule('email.mime.text')
+multiprocessing = LazyModule('multiprocessing')
+pickle = LazyModule('pickle')
+requests = LazyModule('requests')
+shared_memory = LazyModule('multiprocessing.shared_memory')
+smtplib = LazyModule('smtplib')
+socketserver = LazyModule('socketserver')
+
+
+#######################################################################################################
+# request handlers are written as mixins and only combined with their base class (from http.server or
+# socketserver) when a server starts, so runs that serve nothing never import those
+request_handler_classes = {}
+request_handler_classes_lock = threading.Lock()
+
+def get_request_handler(handler, base):
+  with request_handler_classes_lock:
+    if (handler, base) not in request_handler_classes:
+      request_handler_classes[(handler, base)] = type(handler.__name__, (handler, base), {})
+    return request_handler_classes[(handler, base)]
+
+
+#######################################################################################################
+# pipeline metrics - counters and latency histograms for each stage of poll -> match -> notify, so we can
+# see which stage dominates and how long it takes from detecting an opening to sending the alert
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+metrics = {
+  'counters': {},     # name -> count
+  'histograms': {},   # name -> {'buckets': count per latency bucket, 'sum': total seconds, 'count': observations}
+  'lock': threading.Lock()
+}
+
+
+#######################################################################################################
+# add to a counter, e.g. count_metric('poll_errors')
+def count_metric(name, amount=1):
+  with metrics['lock']:
+    metrics['counters'][name] = metrics['counters'].get(name, 0) + amount
+
+
+#######################################################################################################
+# record how many seconds something took
+def observe_latency(name, seconds):
+  with metrics['lock']:
+    histogram = metrics['histograms'].get(name)
+    if histogram is None:
+      histogram = metrics['histograms'][name] = {'buckets': [0] * len(latency_buckets), 'sum': 0.0, 'count': 0}
+    bucket = 0
+    while seconds > latency_buckets[bucket]:
+      bucket += 1
+    histogram['buckets'][bucket] += 1
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+
+
+#######################################################################################################
+# take the metrics gathered so far, starting over from zero - how a shard worker ships its metrics to
+# the coordinator
+def take_metrics():
+  with metrics['lock']:
+    taken = {'counters': metrics['counters'], 'histograms': metrics['histograms']}
+    metrics['counters'] = {}
+    metrics['histograms'] = {}
+  return taken
+
+
+#######################################################################################################
+# add metrics taken in another process to ours
+def merge_metrics(taken):
+  with metrics['lock']:
+    for name, count in taken['counters'].items():
+      metrics['counters'][name] = metrics['counters'].get(name, 0) + count
+    for name, taken_histogram in taken['histograms'].items():
+      histogram = metrics['histograms'].get(name)
+      if histogram is None:
+        histogram = metrics['histograms'][name] = {'buckets': [0] * len(latency_buckets), 'sum': 0.0, 'count': 0}
+      histogram['buckets'] = [count + taken_count for count, taken_count in zip(histogram['buckets'], taken_histogram['buckets'])]
+      histogram['sum'] += taken_histogram['sum']
+      histogram['count'] += taken_histogram['count']
+
+
+#######################################################################################################
+# time a stage of the pipeline, e.g. with time_stage('fetch'): ...
+@contextlib.contextmanager
+def time_stage(name):
+  started = time.perf_counter()
+  try:
+    yield
+  finally:
+    observe_latency(name, time.perf_counter() - started)
+
+
+#######################################################################################################
+# upper bound of the bucket holding the q-th quantile of a histogram
+def latency_quantile(histogram, q):
+  rank = q * histogram['count']
+  seen = 0
+  for bucket, count in enumerate(histogram['buckets']):
+    seen += count
+    if seen >= rank:
+      return latency_buckets[bucket]
+  return latency_buckets[-1]
+
+
+#######################################################################################################
+# metrics in the prometheus text format
+def format_metrics():
+  lines = []
+  with metrics['lock']:
+    for name, count in sorted(metrics['counters'].items()):
+      lines.append('nyvax_' + name + '_total ' + str(count))
+    for name, histogram in sorted(metrics['histograms'].items()):
+      seen = 0
+      for bound, count in zip(latency_buckets, histogram['buckets']):
+        seen += count
+        lines.append('nyvax_' + name + '_seconds_bucket{le="' + ('+Inf' if bound == float('inf') else str(bound)) + '"} ' + str(seen))
+      lines.append('nyvax_' + name + '_seconds_sum ' + str(histogram['sum']))
+      lines.append('nyvax_' + name + '_seconds_count ' + str(histogram['count']))
+  return '\n'.join(lines) + '\n'
+
+
+#######################################################################################################
+# short human readable summary of the metrics, for the periodic stats dump
+def format_metrics_summary():
+  lines = []
+  with metrics['lock']:
+    for name, histogram in sorted(metrics['histograms'].items()):
+      if histogram['count']:
+        lines.append('{name}: n={count} avg={avg:.3f}s p50<={p50}s p95<={p95}s p99<={p99}s'.format(
+          name=name, count=histogram['count'], avg=histogram['sum'] / histogram['count'],
+          p50=latency_quantile(histogram, 0.5), p95=latency_quantile(histogram, 0.95), p99=latency_quantile(histogram, 0.99)))
+    lines.append(' '.join(name + '=' + str(count) for name, count in sorted(metrics['counters'].items())))
+  return '\n'.join(lines)
+
+
+#######################################################################################################
+# serve the metrics at http://host:port/metrics from a background thread, returns the server
+class MetricsHandler:
+  def do_GET(self):
+    if self.path != '/metrics':
+      self.send_error(404)
+      return
+    body = format_metrics().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+def start_metrics_server(port, host='127.0.0.1'):
+  server = http_server.ThreadingHTTPServer((host, port), get_request_handler(MetricsHandler, http_server.BaseHTTPRequestHandler))
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+  return server
+
+
+#######################################################################################################
+# print a metrics summary every dump_frequency seconds from a background thread
+def start_metrics_dump(dump_frequency):
+  def dump_metrics():
+    while True:
+      time.sleep(dump_frequency)
+      print(format_metrics_summary())
+  threading.Thread(target=dump_metrics, name='metrics-dump', daemon=True).start()
+
+
+#######################################################################################################
+# message formats - a subscriber picks one with 'message_format'. the body is header, then the provider
+# names joined by separator, then footer. with a max_length (e.g. for sms) names that don't fit are
+# dropped from the end and counted with more instead
+message_formats = {
+  'email': {'header': 'NY vaccine available! ({now})\n', 'separator': '\n', 'footer': '\n', 'more': '+{count} more\n',
+            'date_format': '%Y-%m-%d %H:%M', 'max_length': 0},
+  'sms': {'header': 'NY vax open {now}: ', 'separator': '; ', 'footer': '', 'more': ' +{count} more',
+          'date_format': '%m/%d %H:%M', 'max_length': 160}
+}
+
+
+#######################################################################################################
+# compile a message format - templates become bound format methods, ready to fill in
+def compile_message_format(message_format):
+  return dict(message_format, header=message_format['header'].format, more=message_format['more'].format)
+
+compiled_message_formats = {name: compile_message_format(message_format) for name, message_format in message_formats.items()}
+
+
+#######################################################################################################
+# rendered message bodies - one opening fanned out to thousands of subscribers mostly renders the same few
+# bodies, so they are cached by format and set of providers. the timestamp only shows minutes, so the
+# cache starts over each minute, which also keeps it from growing
+rendered_messages = {'minute': None, 'times': {}, 'bodies': {}}
+
+
+#######################################################################################################
+# render a message body in a compiled format
+def render_message_body(compiled_format, desired_provider_available_list, now):
+  header = compiled_format['header'](now=now)
+  names = [provider.name for provider in desired_provider_available_list]
+  msg_body = header + compiled_format['separator'].join(names) + compiled_format['footer']
+  max_length = compiled_format['max_length']
+  if max_length and len(msg_body) > max_length:
+    # every name takes at least a character and a separator, so no more than this many can fit
+    kept_names = names[:max_length // (len(compiled_format['separator']) + 1)]
+    while kept_names:
+      kept_names.pop()
+      msg_body = header + compiled_format['separator'].join(kept_names) + compiled_format['more'](count=len(names) - len(kept_names))
+      if len(msg_body) <= max_length:
+        break
+    msg_body = msg_body[:max_length]
   return msg_body
 
 
 #######################################################################################################
-# send message
-def send_message(msg):
+# create message body, see message_formats
+def create_message(desired_provider_available_list, message_format='email'):
+  minute = int(time.time() // 60)
+  if rendered_messages['minute'] != minute:
+    rendered_messages['minute'] = minute
+    rendered_messages['times'] = {}
+    rendered_messages['bodies'] = {}
+
+  key = (message_format, frozenset(provider.key for provider in desired_provider_available_list))
+  msg_body = rendered_messages['bodies'].get(key)
+  if msg_body is None:
+    compiled_format = compiled_message_formats[message_format]
+    now = rendered_messages['times'].get(compiled_format['date_format'])
+    if now is None:
+      now = rendered_messages['times'][compiled_format['date_format']] = datetime.datetime.now().strftime(compiled_format['date_format'])
+    msg_body = rendered_messages['bodies'][key] = render_message_body(compiled_format, desired_provider_available_list, now)
+    count_metric('messages_rendered')
+  return msg_body
+
+
+#######################################################################################################
+# open an authenticated connection to the smtp server in msg
+def open_smtp_connection(msg):
+  # set up smtp params
+  msg_smtpserver = smtplib.SMTP(msg['smtp_api_url'], msg['smtp_api_port'])
+  msg_smtpserver.ehlo()
+  if msg.get('smtp_starttls', True):
+    msg_smtpserver.starttls()
+    msg_smtpserver.ehlo()
+  if msg.get('mail_password'):
+    msg_smtpserver.login(msg['mail_user'], msg['mail_password'])
+  return msg_smtpserver
+
+
+#######################################################################################################
+# fill in message params
+def create_mail_message(mail_user, to, subject, body):
+  mail_msg = mime_text.MIMEText(body)
+  mail_msg['From'] = mail_user
+  mail_msg['To'] = to
+  mail_msg['Subject'] = subject
+  return mail_msg
+
+
+#######################################################################################################
+# serialized mail for a batch - recipients only go on the envelope, so every batch with the same sender,
+# subject and body sends the same bytes and they are built once
+mail_payloads = {}
+mail_payloads_lock = threading.Lock()
+mail_payloads_limit = 256
+
+def get_mail_payload(mail_user, subject, body):
+  key = (mail_user, subject, body)
+  with mail_payloads_lock:
+    mail_payload = mail_payloads.get(key)
+  if mail_payload is None:
+    mail_payload = create_mail_message(mail_user, mail_user, subject, body).as_string()
+    with mail_payloads_lock:
+      if len(mail_payloads) >= mail_payloads_limit:
+        del mail_payloads[next(iter(mail_payloads))]
+      mail_payloads[key] = mail_payload
+  return mail_payload
+
+
+#######################################################################################################
+# notification dispatcher - a queue of notifications drained by worker threads, each keeping its own
+# authenticated smtp connection open between sends, so a burst of alerts doesn't pay for a new
+# connection + login per mail and never blocks polling
+# smtp holds the sender settings - 'mail_user', 'mail_password', 'smtp_api_url', 'smtp_api_port'
+# the dispatcher is also the smtp sink of a notification router, see create_notification_router()
+def create_notification_dispatcher(smtp, workers=2, batch_size=50, max_sends_per_second=5.0, retry=5, max_queue=100000):
+  dispatcher = {
+    'name': 'smtp',
+    'address_field': 'to',        # notifications this sink delivers are the ones with an address in this field
+    'smtp': smtp,
+    'queue': queue.Queue(max_queue),
+    'batch_size': batch_size,     # most notifications taken off the queue at once, identical ones go out as one mail
+    'retry': retry,               # tries per mail before giving up on it
+    'rate_limit': {'interval': 1.0 / max_sends_per_second, 'next_send': 0.0, 'lock': threading.Lock()},
+    'workers': []
+  }
+  for i in range(workers):
+    worker = threading.Thread(target=notification_worker, args=(dispatcher,), name='notification-worker-' + str(i), daemon=True)
+    worker.start()
+    dispatcher['workers'].append(worker)
+  return dispatcher
+
+
+#######################################################################################################
+# queue a notification, returns right away - the dispatcher's workers send it
+def queue_notification(dispatcher, to, subject, body):
+  count_metric('alerts')
+  offer_notification(dispatcher, {'to': to, 'subject': subject, 'body': body, 'queued_at': time.monotonic()})
+
+
+#######################################################################################################
+# add a notification to a sink's queue without ever waiting on it - when the queue is full the oldest
+# notification waiting is dropped (and counted as <sink name>_dropped), so a sink that can't keep up
+# sheds load instead of holding up polling or the other sinks
+def offer_notification(sink, notification):
+  while True:
+    try:
+      sink['queue'].put_nowait(notification)
+      return
+    except queue.Full:
+      try:
+        dropped_notification = sink['queue'].get_nowait()
+        count_metric(sink['name'] + '_dropped')
+        report_delivery(sink, dropped_notification, False)
+      except queue.Empty:
+        pass
+
+
+#######################################################################################################
+# a sink is done with a notification, having delivered it or given up on it. once every sink addressed by
+# the notification is done, its on_delivered(notification, whether any of them delivered it) is called,
+# from the thread of the last sink. the stream sink isn't addressed, so it never reports
+delivery_lock = threading.Lock()
+
+def report_delivery(sink, notification, is_delivered):
+  if sink['address_field'] is None or notification.get('on_delivered') is None:
+    return
+  with delivery_lock:
+    notification['is_delivered'] = notification['is_delivered'] or is_delivered
+    notification['sinks_left'] -= 1
+    if notification['sinks_left']:
+      return
+  notification['on_delivered'](notification, notification['is_delivered'])
+
+
+#######################################################################################################
+# take the next batch off a sink's queue, waiting for the first notification
+# returns (batch, whether the sink was closed) - an empty batch means there is nothing more to do
+def take_notification_batch(sink):
+  notification = sink['queue'].get()
+  if notification is None:
+    return [], True
+
+  # take whatever else is already waiting, up to a batch
+  batch = [notification]
+  while len(batch) < sink['batch_size']:
+    try:
+      notification = sink['queue'].get_nowait()
+    except queue.Empty:
+      break
+    if notification is None:
+      return batch, True
+    batch.append(notification)
+  return batch, False
+
+
+#######################################################################################################
+# send everything still queued, then stop the dispatcher's workers - works for any notification sink
+def close_notification_dispatcher(dispatcher):
+  for worker in dispatcher['workers']:
+    dispatcher['queue'].put(None)
+  for worker in dispatcher['workers']:
+    worker.join()
+  for server in dispatcher.get('servers', ()):
+    server.shutdown()
+    server.server_close()
+  if dispatcher.get('socket_path') and os.path.exists(dispatcher['socket_path']):
+    os.unlink(dispatcher['socket_path'])
+
+
+#######################################################################################################
+# wait until the rate limit allows another send - shared by all of a dispatcher's workers
+def wait_for_send_slot(rate_limit):
+  with rate_limit['lock']:
+    now = time.monotonic()
+    send_at = max(now, rate_limit['next_send'])
+    rate_limit['next_send'] = send_at + rate_limit['interval']
+  if send_at > now:
+    time.sleep(send_at - now)
+
+
+#######################################################################################################
+# send one mail to a batch of notifications with the same subject and body, reconnecting and backing off
+# on failure. returns the smtp connection to reuse for the next batch, or None if it had to be dropped
+def send_notification_batch(dispatcher, msg_smtpserver, subject, body, notifications):
+  smtp = dispatcher['smtp']
+  to_list = [notification['to'] for notification in notifications]
+  # recipients only go on the envelope, so they don't see each other
+  mail_msg = get_mail_payload(smtp['mail_user'], subject, body)
+
+  retry = dispatcher['retry']
+  backoff = 1.0
+  while True:
+    wait_for_send_slot(dispatcher['rate_limit'])
+    try:
+      if msg_smtpserver is None:
+        msg_smtpserver = open_smtp_connection(smtp)
+      with time_stage('send'):
+        refused = msg_smtpserver.sendmail(smtp['mail_user'], to_list, mail_msg)
+      # how long from queueing the alert (right when the opening was matched) until it went out
+      sent_at = time.monotonic()
+      for notification in notifications:
+        observe_latency('detection_to_notification', sent_at - notification['queued_at'])
+      count_metric('notifications_sent', len(to_list) - len(refused))
+      count_metric('notifications_refused', len(refused))
+      for notification in notifications:
+        report_delivery(dispatcher, notification, notification['to'] not in refused)
+      if refused:
+        print('Notification refused for ' + ', '.join(refused))
+      if __debug__:
+        print('Sent "' + subject + '" to ' + str(len(to_list) - len(refused)) + ' recipient(s)')
+      return msg_smtpserver
+    except smtplib.SMTPRecipientsRefused:
+      # every recipient refused, trying again won't help
+      count_metric('notifications_refused', len(to_list))
+      print('Notification refused for ' + ', '.join(to_list))
+      for notification in notifications:
+        report_delivery(dispatcher, notification, False)
+      return msg_smtpserver
+    except Exception:
+      if __debug__:
+        traceback.print_exc()
+      # start over with a fresh connection
+      if msg_smtpserver is not None:
+        try:
+          msg_smtpserver.close()
+        except Exception:
+          pass
+        msg_smtpserver = None
+      retry -= 1
+      if retry <= 0:
+        count_metric('notifications_failed', len(to_list))
+        print('Could not send notification to ' + ', '.join(to_list))
+        for notification in notifications:
+          report_delivery(dispatcher, notification, False)
+        return None
+      count_metric('notification_retries')
+      time.sleep(backoff)
+      backoff = min(backoff * 2, 60.0)
+
+
+#######################################################################################################
+# notification worker thread - drain the queue in batches until the dispatcher is closed
+def notification_worker(dispatcher):
+  msg_smtpserver = None
+  is_closed = False
+  while not is_closed:
+    batch, is_closed = take_notification_batch(dispatcher)
+
+    # identical messages go out as one mail to all of their recipients
+    notifications_by_message = {}
+    for notification in batch:
+      notifications_by_message.setdefault((notification['subject'], notification['body']), []).append(notification)
+    for (subject, body), notifications in notifications_by_message.items():
+      msg_smtpserver = send_notification_batch(dispatcher, msg_smtpserver, subject, body, notifications)
+
+  if msg_smtpserver is not None:
+    try:
+      msg_smtpserver.quit()
+    except Exception:
+      pass
+
+
+#######################################################################################################
+# local smtp sink - accepts and counts mail without delivering it, so notification throughput can be
+# measured offline. point a dispatcher at it with 'smtp_starttls': False, e.g.
+#   sink = start_smtp_sink()
+#   smtp = {'mail_user': 'me@localhost', 'mail_password': '', 'smtp_api_url': '127.0.0.1',
+#           'smtp_api_port': sink.server_address[1], 'smtp_starttls': False}
+class SmtpSinkHandler:
+  def reply(self, line):
+    self.wfile.write(line.encode('ascii') + b'\r\n')
+
+  def handle(self):
+    self.reply('220 localhost smtp sink')
+    recipient_count = 0
+    for line in self.rfile:
+      command = line.decode('ascii', 'replace').strip().upper()
+      if command.startswith('EHLO'):
+        self.wfile.write(b'250-localhost\r\n')
+        self.reply('250 AUTH PLAIN LOGIN')
+      elif command.startswith('HELO'):
+        self.reply('250 localhost')
+      elif command.startswith('AUTH'):
+        self.reply('235 accepted')
+      elif command.startswith('MAIL'):
+        recipient_count = 0
+        self.reply('250 ok')
+      elif command.startswith('RCPT'):
+        recipient_count += 1
+        self.reply('250 ok')
+      elif command == 'DATA':
+        self.reply('354 end with .')
+        for data_line in self.rfile:
+          if data_line.rstrip(b'\r\n') == b'.':
+            break
+        with self.server.lock:
+          self.server.message_count += 1
+          self.server.recipient_count += recipient_count
+        self.reply('250 ok')
+      elif command == 'QUIT':
+        self.reply('221 bye')
+        return
+      elif command in ('RSET', 'NOOP'):
+        self.reply('250 ok')
+      else:
+        self.reply('502 not implemented')
+
+
+#######################################################################################################
+# start a local smtp sink in a background thread - port 0 picks a free port
+# the returned server counts what it received in message_count and recipient_count, call shutdown() to stop it
+def start_smtp_sink(host='127.0.0.1', port=0):
+  server = socketserver.ThreadingTCPServer((host, port), get_request_handler(SmtpSinkHandler, socketserver.StreamRequestHandler))
+  server.daemon_threads = True
+  server.lock = threading.Lock()
+  server.message_count = 0
+  server.recipient_count = 0
+  threading.Thread(target=server.serve_forever, name='smtp-sink', daemon=True).start()
+  return server
+
+
+#######################################################################################################
+# webhook sink - posts notifications as json to each subscriber's 'webhook' url, batched per url, over a
+# pooled session of its own so it never waits behind vaccine api fetches. each post is
+#   {"notifications": [{"subscriber": name, "subject": ..., "body": ..., "providers": [...], "time": epoch seconds}]}
+def create_webhook_sink(workers=2, batch_size=100, max_queue=10000, timeout=(3.0, 10.0), retry=3):
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  sink = {
+    'name': 'webhook',
+    'address_field': 'webhook',
+    'queue': queue.Queue(max_queue),
+    'batch_size': batch_size,
+    'session': session,
+    'timeout': timeout,         # (connect, read) seconds per post
+    'retry': retry,             # tries per post before giving up on it
+    'workers': []
+  }
+  for i in range(workers):
+    worker = threading.Thread(target=webhook_worker, args=(sink,), name='webhook-worker-' + str(i), daemon=True)
+    worker.start()
+    sink['workers'].append(worker)
+  return sink
+
+
+#######################################################################################################
+# what a notification looks like to a webhook or stream client
+def format_notification_event(notification):
+  return {key: notification[key] for key in ('subscriber', 'subject', 'body', 'providers', 'time')}
+
+
+#######################################################################################################
+# webhook worker thread - drain the queue in batches, one post per url in the batch
+def webhook_worker(sink):
+  is_closed = False
+  while not is_closed:
+    batch, is_closed = take_notification_batch(sink)
+    notifications_by_url = {}
+    for notification in batch:
+      notifications_by_url.setdefault(notification['webhook'], []).append(notification)
+    for url, notifications in notifications_by_url.items():
+      is_delivered = post_webhook_batch(sink, url, notifications)
+      for notification in notifications:
+        report_delivery(sink, notification, is_delivered)
+  sink['session'].close()
+
+
+#######################################################################################################
+# post one batch to a webhook, backing off between tries
+def post_webhook_batch(sink, url, notifications):
+  payload = json.dumps({'notifications': [format_notification_event(notification) for notification in notifications]})
+  backoff = 0.5
+  for attempt in range(sink['retry']):
+    try:
+      with time_stage('webhook'):
+        response = sink['session'].post(url, data=payload, headers={'Content-Type': 'application/json'}, timeout=sink['timeout'])
+      response.close()
+      if response.status_code < 400:
+        sent_at = time.monotonic()
+        for notification in notifications:
+          observe_latency('detection_to_webhook', sent_at - notification['queued_at'])
+        count_metric('webhooks_sent', len(notifications))
+        return True
+      if response.status_code < 500 and response.status_code != 429:
+        break     # the hook doesn't want it, trying again won't help
+    except requests.RequestException:
+      if __debug__:
+        traceback.print_exc()
+    if attempt + 1 < sink['retry']:
+      time.sleep(backoff)
+      backoff *= 2
+  count_metric('webhooks_failed', len(notifications))
+  print('Could not post notification to ' + url)
+  return False
+
+
+#######################################################################################################
+# notification stream sink - every notification, as one json event, to every local process listening on
+# a unix socket (one event per line) and/or over http as server-sent events at http://host:port/events
+# each listener gets its own queue of up to client_queue events, so a slow one only drops its own events
+def start_notification_stream(socket_path=None, port=None, host='127.0.0.1', max_queue=10000, client_queue=1000):
+  sink = {
+    'name': 'stream',
+    'address_field': None,      # every notification goes to the stream
+    'queue': queue.Queue(max_queue),
+    'clients': set(),           # one queue per listener
+    'clients_lock': threading.Lock(),
+    'client_queue': client_queue,
+    'workers': [],
+    'servers': []
+  }
+  worker = threading.Thread(target=notification_stream_worker, args=(sink,), name='notification-stream', daemon=True)
+  worker.start()
+  sink['workers'].append(worker)
+
+  if socket_path:
+    # a socket left behind by a previous run would stop us binding
+    if os.path.exists(socket_path):
+      os.unlink(socket_path)
+    sink['servers'].append(socketserver.ThreadingUnixStreamServer(socket_path, get_request_handler(NotificationSocketHandler, socketserver.StreamRequestHandler)))
+    sink['socket_path'] = socket_path
+  if port is not None:
+    sink['servers'].append(http_server.ThreadingHTTPServer((host, port), get_request_handler(NotificationEventsHandler, http_server.BaseHTTPRequestHandler)))
+  for server in sink['servers']:
+    server.daemon_threads = True
+    server.sink = sink
+    threading.Thread(target=server.serve_forever, name='notification-stream-server', daemon=True).start()
+  return sink
+
+
+#######################################################################################################
+# start and stop listening to a notification stream - returns the queue the listener's events arrive on
+def subscribe_notification_stream(sink):
+  client = queue.Queue(sink['client_queue'])
+  with sink['clients_lock']:
+    sink['clients'].add(client)
+  return client
+
+def unsubscribe_notification_stream(sink, client):
+  with sink['clients_lock']:
+    sink['clients'].discard(client)
+
+
+#######################################################################################################
+# notification stream thread - hand each notification to every listener, None tells them the stream ended
+def notification_stream_worker(sink):
+  while True:
+    notification = sink['queue'].get()
+    event = None if notification is None else json.dumps(format_notification_event(notification))
+    with sink['clients_lock']:
+      clients = list(sink['clients'])
+    for client in clients:
+      try:
+        client.put_nowait(event)
+      except queue.Full:
+        if event is None:
+          # make room for the end of the stream
+          client.get_nowait()
+          client.put_nowait(None)
+        else:
+          count_metric('stream_client_dropped')
+    if notification is None:
+      break
+    count_metric('stream_events', len(clients))
+
+
+#######################################################################################################
+# unix socket listener - one json event per line, a socketserver.StreamRequestHandler
+class NotificationSocketHandler:
+  def handle(self):
+    sink = self.server.sink
+    client = subscribe_notification_stream(sink)
+    try:
+      while True:
+        event = client.get()
+        if event is None:
+          return
+        self.wfile.write(event.encode('utf-8') + b'\n')
+    except OSError:
+      pass    # listener went away
+    finally:
+      unsubscribe_notification_stream(sink, client)
+
+
+#######################################################################################################
+# server-sent events listener, e.g. curl -N http://127.0.0.1:<port>/events - an http.server.BaseHTTPRequestHandler
+class NotificationEventsHandler:
+  def do_GET(self):
+    if self.path != '/events':
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+
+    sink = self.server.sink
+    client = subscribe_notification_stream(sink)
+    try:
+      while True:
+        try:
+          event = client.get(timeout=15.0)
+        except queue.Empty:
+          # keep idle connections open, and find out about ones that closed
+          self.wfile.write(b': keepalive\n\n')
+          continue
+        if event is None:
+          return
+        self.wfile.write(b'data: ' + event.encode('utf-8') + b'\n\n')
+    except OSError:
+      pass    # listener went away
+    finally:
+      unsubscribe_notification_stream(sink, client)
+
+  def log_message(self, format, *args):
+    pass
+
+
+#######################################################################################################
+# notification router - fans each alert out to every sink that can deliver it: the smtp dispatcher for
+# subscribers with a 'to' address, the webhook sink for ones with a 'webhook' url, and the stream for
+# everyone. every sink has its own queue and workers, so a slow smtp relay never holds up the fast ones
+def create_notification_router(sinks):
+  return {'sinks': [sink for sink in sinks if sink is not None]}
+
+
+#######################################################################################################
+# does any subscriber want alerts posted to a webhook
+def has_webhook_subscribers(subscribers):
+  return any(subscriber['msg'].get('webhook') for subscriber in subscribers)
+
+
+#######################################################################################################
+# route an alert to a subscriber through every sink that applies
+# on_delivered(notification, is_delivered), if given, is called once the sinks addressed are done with it
+def route_notification(router, subscriber, subject, body, desired_provider_available_list, on_delivered=None):
+  count_metric('alerts')
+  msg = subscriber['msg']
+  notification = {
+    'subscriber': subscriber['name'],
+    'to': msg.get('to'),
+    'webhook': msg.get('webhook'),
+    'subject': subject,
+    'body': body,
+    'providers': [{'provider_id': provider.provider_id, 'name': provider.name, 'vaccine_brand': provider.vaccine_brand, 'address': provider.address}
+                  for provider in desired_provider_available_list],
+    'time': time.time(),
+    'queued_at': time.monotonic(),
+    'on_delivered': on_delivered,
+    'is_delivered': False,
+    'sinks_left': 0       # addressed sinks that haven't reported on it yet
+  }
+  sinks = [sink for sink in router['sinks'] if sink['address_field'] is None or notification[sink['address_field']]]
+  notification['sinks_left'] = sum(1 for sink in sinks if sink['address_field'] is not None)
+  if on_delivered is not None and not notification['sinks_left']:
+    # nowhere to deliver it
+    on_delivered(notification, False)
+  for sink in sinks:
+    offer_notification(sink, notification)
+
+
+#######################################################################################################
+# deliver everything still queued on every sink, then stop them
+def close_notification_router(router):
+  for sink in router['sinks']:
+    close_notification_dispatcher(sink)
+
+
+#######################################################################################################
+# provider record - every feed adapter decodes its api's providers into these, so matching, diffing and
+# messages work the same whatever the source. key is a small int unique to the provider across all feeds
+class ProviderRecord:
+  __slots__ = ('key', 'provider_id', 'name', 'vaccine_brand', 'address', 'is_available')
+
+  def __init__(self, key, provider_id, name, vaccine_brand, address, is_available):
+    self.key = key
+    self.provider_id = provider_id
+    self.name = name
+    self.vaccine_brand = vaccine_brand
+    self.address = address
+    self.is_available = is_available
+
+  def __eq__(self, other):
+    return isinstance(other, ProviderRecord) and all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+  def __repr__(self):
+    return 'ProviderRecord(' + ', '.join(slot + '=' + repr(getattr(self, slot)) for slot in self.__slots__) + ')'
+
+
+# record attributes for the api field names subscribers match on, e.g. 'desired_field_values': {'vaccineBrand': [...]}
+provider_record_fields = {
+  'providerId': 'provider_id',
+  'providerName': 'name',
+  'vaccineBrand': 'vaccine_brand',
+  'address': 'address'
+}
+
+
+#######################################################################################################
+# interned provider keys - (feed url, provider id) -> key, handed out in order so they stay small
+provider_keys = {}
+provider_keys_lock = threading.Lock()
+
+def intern_provider_key(feed, provider_id):
+  key = provider_keys.get((feed, provider_id))
+  if key is None:
+    with provider_keys_lock:
+      key = provider_keys.setdefault((feed, provider_id), len(provider_keys))
+  return key
+
+
+#######################################################################################################
+# NY state api provider, see the expected vaccine api response format at the bottom of the file
+def decode_ny_provider(provider, vaccine_api):
+  return ProviderRecord(intern_provider_key(vaccine_api['url'], provider['providerId']), provider['providerId'],
+                        provider['providerName'], sys.intern(provider.get('vaccineBrand') or ''), sys.intern(provider.get('address') or ''),
+                        provider['availableAppointments'] == 'Y')
+
+
+#######################################################################################################
+# provider from any api laid out like NY's, with the field names given in the vaccine_api settings
+def decode_fields_provider(provider, vaccine_api):
+  provider_id = provider[vaccine_api['provider_id_field']]
+  return ProviderRecord(intern_provider_key(vaccine_api['url'], provider_id), provider_id,
+                        provider[vaccine_api['provider_name_field']],
+                        sys.intern(provider.get(vaccine_api.get('vaccine_brand_field', 'vaccineBrand')) or ''),
+                        sys.intern(provider.get(vaccine_api.get('address_field', 'address')) or ''),
+                        provider[vaccine_api['available_appointments_field']] == vaccine_api['available_appointments_value'])
+
+
+#######################################################################################################
+# feed adapters by name - a vaccine_api picks one with 'feed_adapter', add one here for each new source
+# an adapter turns one provider as it comes from the api into a ProviderRecord
+feed_adapters = {
+  'ny': decode_ny_provider,
+  'fields': decode_fields_provider
+}
+
+
+#######################################################################################################
+# decode a vaccine api's providers into provider records as they are iterated
+def decode_provider_list(provider_list, vaccine_api):
+  decode_provider = feed_adapters[vaccine_api.get('feed_adapter', 'fields')]
+  for provider in provider_list:
+    yield decode_provider(provider, vaccine_api)
+
+
+#######################################################################################################
+# determine if there is availability at any of the desired providers
+# desired_provider_id_values should be a set, so this is a single hash lookup
+def desired_provider_match(provider, desired_provider_id_values):
+  is_desired_provider_match = provider.provider_id in desired_provider_id_values
+  return is_desired_provider_match
+
+
+#######################################################################################################
+# offline gazetteer - place name -> (latitude, longitude), used to locate providers by their address and
+# subscribers by the place they give. covers the NY sites, add more with the 'gazetteer_path' setting
+gazetteer = {
+  'albany, ny': (42.6526, -73.7562),
+  'batavia, ny': (42.9981, -78.1875),
+  'binghamton, ny': (42.0987, -75.9180),
+  'brentwood, ny': (40.7812, -73.2462),
+  'bronx, ny': (40.8448, -73.8648),
+  'brooklyn, ny': (40.6782, -73.9442),
+  'buffalo, ny': (42.8864, -78.8784),
+  'corning, ny': (42.1429, -77.0547),
+  'henrietta, ny': (43.0592, -77.6122),
+  'ithaca, ny': (42.4440, -76.5019),
+  'jamaica, ny': (40.7027, -73.7890),
+  'johnson city, ny': (42.1156, -75.9588),
+  'middletown, ny': (41.4459, -74.4229),
+  'new paltz, ny': (41.7476, -74.0868),
+  'new york, ny': (40.7128, -74.0060),
+  'niagara falls, ny': (43.0962, -79.0377),
+  'old westbury, ny': (40.7887, -73.5996),
+  'olean, ny': (42.0776, -78.4297),
+  'oneonta, ny': (42.4529, -75.0638),
+  'plattsburgh, ny': (44.6995, -73.4529),
+  'potsdam, ny': (44.6698, -74.9813),
+  'poughkeepsie, ny': (41.7004, -73.9210),
+  'queens, ny': (40.7282, -73.7949),
+  'queensbury, ny': (43.3773, -73.6135),
+  'rochester, ny': (43.1566, -77.6088),
+  'schenectady, ny': (42.8142, -73.9396),
+  'south ozone park, ny': (40.6765, -73.8166),
+  'southampton, ny': (40.8843, -72.3895),
+  'southhampton, ny': (40.8843, -72.3895),    # as the NY api spells it
+  'staten island, ny': (40.5795, -74.1502),
+  'stony brook, ny': (40.9257, -73.1409),
+  'syracuse, ny': (43.0481, -76.1474),
+  'troy, ny': (42.7284, -73.6918),
+  'utica, ny': (43.1009, -75.2327),
+  'wantagh, ny': (40.6837, -73.5101),
+  'white plains, ny': (41.0340, -73.7629),
+  'yonkers, ny': (40.9312, -73.8988)
+}
+geocoded_places = {}    # place as given -> (latitude, longitude) or None, so each one is looked up once
+
+
+#######################################################################################################
+# gazetteer key for a place name - case and spacing don't matter
+def normalize_place(place):
+  return ' '.join(place.lower().replace(',', ', ').split())
+
+
+#######################################################################################################
+# add places to the gazetteer from a json file of {"Place, ST": [latitude, longitude]}
+def load_gazetteer(gazetteer_path):
+  with open(gazetteer_path) as gazetteer_file:
+    places = json.load(gazetteer_file)
+  gazetteer.update((normalize_place(place), (float(location[0]), float(location[1]))) for place, location in places.items())
+  geocoded_places.clear()
+  provider_locations.clear()
+
+
+#######################################################################################################
+# (latitude, longitude) of a place name, or None if the gazetteer doesn't know it
+def geocode_place(place):
+  location = geocoded_places.get(place)
+  if location is None and place not in geocoded_places:
+    location = geocoded_places[place] = gazetteer.get(normalize_place(place))
+  return location
+
+
+#######################################################################################################
+# a subscriber's (latitude, longitude, radius in miles), or None if they don't match on distance
+# 'location' is a place name from the gazetteer, e.g. 'White Plains, NY', or [latitude, longitude]
+def get_subscriber_location(subscriber):
+  location = subscriber.get('location')
+  if location is None:
+    return None
+  if isinstance(location, str):
+    place = location
+    location = geocode_place(place)
+    if location is None:
+      raise ValueError('Unknown location for subscriber ' + subscriber['name'] + ': ' + place)
+  return float(location[0]), float(location[1]), float(subscriber.get('radius_miles', 25.0))
+
+
+#######################################################################################################
+# great circle distance in miles
+def distance_miles(latitude, longitude, other_latitude, other_longitude):
+  latitude, longitude, other_latitude, other_longitude = map(math.radians, (latitude, longitude, other_latitude, other_longitude))
+  a = math.sin((other_latitude - latitude) / 2) ** 2 + math.cos(latitude) * math.cos(other_latitude) * math.sin((other_longitude - longitude) / 2) ** 2
+  return 2 * 3958.8 * math.asin(math.sqrt(a))
+
+
+#######################################################################################################
+# spatial grid - subscribers are filed under every grid cell their radius reaches, so finding who is near
+# a provider is one cell lookup plus a distance check for the few subscribers filed there
+grid_degrees = 0.25     # cell size, about 17 miles north to south
+
+def grid_cell(latitude, longitude):
+  return math.floor(latitude / grid_degrees), math.floor(longitude / grid_degrees)
+
+
+#######################################################################################################
+# the grid cells a circle overlaps
+def grid_cells_within(latitude, longitude, radius_miles):
+  latitude_miles = radius_miles / 69.0
+  longitude_miles = radius_miles / (69.0 * max(math.cos(math.radians(latitude)), 0.01))
+  south, west = grid_cell(latitude - latitude_miles, longitude - longitude_miles)
+  north, east = grid_cell(latitude + latitude_miles, longitude + longitude_miles)
+  return [(row, column) for row in range(south, north + 1) for column in range(west, east + 1)]
+
+
+#######################################################################################################
+# where a provider is, geocoded from its address once per provider
+provider_locations = {}    # provider key -> (latitude, longitude) or None
+
+def get_provider_location(provider):
+  location = provider_locations.get(provider.key)
+  if location is None and provider.key not in provider_locations:
+    location = provider_locations[provider.key] = geocode_place(provider.address) if provider.address else None
+  return location
+
+
+#######################################################################################################
+# subscription index - for every field subscribers match on, maps each wanted value to the names of the
+# subscribers that want it, so one pass over the provider list finds every subscriber's matches
+# subscribers with a location are also filed in a spatial grid, and being in range counts as one more field
+def create_subscription_index():
+  return {
+    'fields': {},             # provider record attribute -> {value -> set of subscriber names}
+    'criteria_counts': {},    # subscriber name -> number of criteria that subscriber matches on
+    'locations': {},          # subscriber name -> (latitude, longitude, radius in miles)
+    'grid': {},               # grid cell -> set of names of subscribers whose radius reaches it
+    'subscribers': {}         # subscriber name -> subscriber
+  }
+
+
+#######################################################################################################
+# what a subscriber wants to match on, as {provider record attribute: list of wanted values}
+# a provider matches when it has one of the wanted values for every attribute
+def get_subscriber_criteria(subscriber):
+  # e.g. {'vaccineBrand': ['Pfizer'], 'address': ['White Plains, NY']} - api field names or record attributes
+  criteria = {provider_record_fields.get(field, field): values for field, values in subscriber.get('desired_field_values', {}).items()}
+  # desired_provider_id_values is shorthand for matching on the provider id
+  if subscriber.get('desired_provider_id_values'):
+    criteria['provider_id'] = subscriber['desired_provider_id_values']
+  return criteria
+
+
+#######################################################################################################
+# add a subscriber to the subscription index
+def add_subscription(index, subscriber):
+  name = subscriber['name']
+  criteria = get_subscriber_criteria(subscriber)
+  location = get_subscriber_location(subscriber)
+  index['subscribers'][name] = subscriber
+  index['criteria_counts'][name] = len(criteria) + (location is not None)
+  for field, values in criteria.items():
+    field_index = index['fields'].setdefault(field, {})
+    for value in values:
+      field_index.setdefault(value, set()).add(name)
+  if location is not None:
+    index['locations'][name] = location
+    for cell in grid_cells_within(*location):
+      index['grid'].setdefault(cell, set()).add(name)
+
+
+#######################################################################################################
+# remove a subscriber from the subscription index
+def remove_subscription(index, name):
+  subscriber = index['subscribers'].pop(name)
+  del index['criteria_counts'][name]
+  for field, values in get_subscriber_criteria(subscriber).items():
+    field_index = index['fields'][field]
+    for value in values:
+      names = field_index.get(value)
+      if names:
+        names.discard(name)
+        if not names:
+          del field_index[value]
+    if not field_index:
+      del index['fields'][field]
+  location = index['locations'].pop(name, None)
+  if location is not None:
+    for cell in grid_cells_within(*location):
+      names = index['grid'][cell]
+      names.discard(name)
+      if not names:
+        del index['grid'][cell]
+
+
+#######################################################################################################
+# build a subscription index for a list of subscribers
+def build_subscription_index(subscribers):
+  index = create_subscription_index()
+  for subscriber in subscribers:
+    add_subscription(index, subscriber)
+  return index
+
+
+#######################################################################################################
+# find every subscriber's matches in one pass over the provider list
+# returns {subscriber name: list of available providers that subscriber wants}
+def match_subscriptions(index, provider_list):
+  fields = list(index['fields'].items())
+  criteria_counts = index['criteria_counts']
+  locations = index['locations']
+  grid = index['grid']
+
+  matches = {}
+  for provider in provider_list:
+    if not provider.is_available:
+      continue
+
+    # count how many of each subscriber's fields this provider satisfies
+    hits = {}
+    for field, field_index in fields:
+      names = field_index.get(getattr(provider, field, None))
+      if names:
+        for name in names:
+          hits[name] = hits.get(name, 0) + 1
+
+    # and whether it's within each nearby subscriber's radius
+    provider_location = get_provider_location(provider) if grid else None
+    if provider_location is not None:
+      for name in grid.get(grid_cell(*provider_location), ()):
+        latitude, longitude, radius_miles = locations[name]
+        if distance_miles(latitude, longitude, *provider_location) <= radius_miles:
+          hits[name] = hits.get(name, 0) + 1
+
+    for name, count in hits.items():
+      if count == criteria_counts[name]:
+        matches.setdefault(name, []).append(provider)
+
+  return matches
+  
+
+#######################################################################################################
+# availability snapshot for one vaccine api - what we last reported for each provider, so we only alert
+# when availability changes. a provider has to show a new state for open_debounce (N->Y) or
+# close_debounce (Y->N) polls in a row before the transition is reported, so a site flapping open and
+# closed does not re-alert on every poll
+def create_availability_snapshot(open_debounce=1, close_debounce=3):
+  return {
+    'available': {},          # provider key -> provider, for the providers last reported as available
+    'pending': {},            # provider key -> [is_available, polls seen in that state, provider]
+    'open_debounce': open_debounce,
+    'close_debounce': close_debounce
+  }
+
+
+#######################################################################################################
+# count one more poll of a provider in a state that differs from what we last reported
+# returns True once the provider has been in that state long enough to report the transition
+def advance_pending_transition(snapshot, is_available, provider):
+  pending = snapshot['pending'].get(provider.key)
+  if pending is None or pending[0] != is_available:
+    pending = snapshot['pending'][provider.key] = [is_available, 0, provider]
+  pending[1] += 1
+  pending[2] = provider
+  if pending[1] < (snapshot['open_debounce'] if is_available else snapshot['close_debounce']):
+    return False
+
+  del snapshot['pending'][provider.key]
+  if is_available:
+    snapshot['available'][provider.key] = provider
+  else:
+    snapshot['available'].pop(provider.key, None)
+  return True
+
+
+#######################################################################################################
+# diff a poll against the snapshot, returns (list of providers that opened, list of providers that closed)
+# provider_list is None when the api reported nothing changed, which still counts as a poll for debouncing
+# a provider list that fails part way through (e.g. a streamed body cut off) leaves the snapshot as it was
+def diff_availability(snapshot, provider_list):
+  opened_provider_list = []
+  closed_provider_list = []
+
+  if provider_list is None:
+    # same states as last poll, so only providers already on their way to a transition can change
+    for is_available, count, provider in list(snapshot['pending'].values()):
+      if advance_pending_transition(snapshot, is_available, provider):
+        (opened_provider_list if is_available else closed_provider_list).append(provider)
+    return opened_provider_list, closed_provider_list
+
+  # diff into a copy, swapped in once the whole list has been seen
+  working_snapshot = dict(snapshot, available=dict(snapshot['available']), pending={provider_key: list(transition) for provider_key, transition in snapshot['pending'].items()})
+  available = working_snapshot['available']
+  pending = working_snapshot['pending']
+  seen_provider_keys = set()
+  for provider in provider_list:
+    seen_provider_keys.add(provider.key)
+    if provider.is_available == (provider.key in available):
+      # same as we last reported, forget any half-way transition
+      pending.pop(provider.key, None)
+    elif advance_pending_transition(working_snapshot, provider.is_available, provider):
+      (opened_provider_list if provider.is_available else closed_provider_list).append(provider)
+
+  # providers that dropped off the list are no longer available either
+  for provider_key in available.keys() - seen_provider_keys:
+    provider = available[provider_key]
+    if advance_pending_transition(working_snapshot, False, provider):
+      closed_provider_list.append(provider)
+
+  snapshot['available'] = available
+  snapshot['pending'] = pending
+  return opened_provider_list, closed_provider_list
+
+
+#######################################################################################################
+# poll schedule for one vaccine api - how long to wait before the next poll. polls come faster during
+# hot hours (configured, or hours we have seen availability flip in), back off exponentially on errors
+# and while the api's lastUpdated doesn't move, and are jittered so a fleet of watchers spreads out
+# with a history store, polls also come fast from lead_minutes ahead of the times of day sites tend to
+# open (see forecast_opening_windows()), however far they had backed off, so the first poll of the lead-in
+# re-opens the kept-alive connection and the polls that catch the opening don't pay for a handshake
+def create_poll_schedule(check_frequency=30.0, min_frequency=10.0, max_frequency=300.0, hot_hours=(), jitter=0.1,
+                         window_minutes=15, lead_minutes=5, forecast_frequency=3600.0):
+  return {
+    'check_frequency': check_frequency,   # normal seconds between polls
+    'min_frequency': min_frequency,       # seconds between polls during hot hours
+    'max_frequency': max_frequency,       # longest we ever back off to
+    'hot_hours': set(hot_hours),          # hours of the day (0-23) to always poll fast
+    'jitter': jitter,                     # +/- fraction of randomness added to each wait
+    'flips_by_hour': [0] * 24,            # availability transitions seen in each hour of the day
+    'errors': 0,                          # failed polls in a row
+    'unchanged': 0,                       # polls in a row where lastUpdated didn't move
+    'window_minutes': window_minutes,     # size of the time of day windows openings are forecast in
+    'lead_minutes': lead_minutes,         # minutes ahead of a likely window to start polling fast
+    'likely_windows': set(),              # windows (minute of the day // window_minutes) sites tend to open in
+    'forecast_frequency': forecast_frequency,   # seconds between forecasts from the history store
+    'forecast_at': None                   # time.monotonic() of the last forecast
+  }
+
+# most errors / unchanged polls in a row backed off for - far past max_frequency already, and days of
+# them would otherwise overflow the float
+max_backoff_steps = 32
+
+
+#######################################################################################################
+# record how a poll went
+def record_poll_result(schedule, is_error, is_changed=False, transition_count=0):
+  if is_error:
+    schedule['errors'] += 1
+    return
+  schedule['errors'] = 0
+  schedule['unchanged'] = 0 if is_changed else schedule['unchanged'] + 1
+  schedule['flips_by_hour'][datetime.datetime.now().hour] += transition_count
+
+
+#######################################################################################################
+# did a poll bring anything new - a new body whose lastUpdated moved on from last_updated, or any new body
+# from an api that doesn't send lastUpdated at all
+def is_poll_changed(url, is_fetched, last_updated):
+  new_last_updated = vaccine_api_cache[url]['last_updated']
+  return is_fetched and (new_last_updated is None or new_last_updated != last_updated)
+
+
+#######################################################################################################
+# is this an hour when availability tends to flip
+def is_hot_hour(schedule, hour):
+  if hour in schedule['hot_hours']:
+    return True
+  flips_by_hour = schedule['flips_by_hour']
+  return flips_by_hour[hour] >= max(3, 2 * sum(flips_by_hour) / 24)
+
+
+#######################################################################################################
+# is now in, or in the lead-in to, a window when sites tend to open
+def is_likely_opening(schedule, now):
+  minute = now.hour * 60 + now.minute
+  return any((minute + offset) % 1440 // schedule['window_minutes'] in schedule['likely_windows'] for offset in (0, schedule['lead_minutes']))
+
+
+#######################################################################################################
+# seconds from now until the lead-in to the next likely window starts
+def seconds_until_likely_opening(schedule, now):
+  second = now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+  return min(((window * schedule['window_minutes'] - schedule['lead_minutes']) * 60 - second) % 86400 for window in schedule['likely_windows']) \
+         if schedule['likely_windows'] else float('inf')
+
+
+#######################################################################################################
+# seconds to wait before the next poll, given how long the last poll itself took
+def next_poll_delay(schedule, elapsed=0.0):
+  now = datetime.datetime.now()
+  if schedule['errors']:
+    delay = schedule['check_frequency'] * 2 ** min(schedule['errors'], max_backoff_steps)
+  elif is_hot_hour(schedule, now.hour) or is_likely_opening(schedule, now):
+    # never slower than usual, even when min_frequency is configured above check_frequency
+    delay = min(schedule['check_frequency'], schedule['min_frequency'])
+  else:
+    delay = schedule['check_frequency'] * 1.5 ** min(schedule['unchanged'], max_backoff_steps)
+  delay = min(delay, schedule['max_frequency'])
+  # never sleep through the start of a likely opening's lead-in, but never poll faster than min_frequency
+  # either, and jitter after that, so a fleet of watchers doesn't all wake up on the same second
+  delay = min(delay, max(seconds_until_likely_opening(schedule, now), min(schedule['check_frequency'], schedule['min_frequency'])))
+  delay *= random.uniform(1.0 - schedule['jitter'], 1.0 + schedule['jitter'])
+  return max(0.0, delay - elapsed)
+
+
+#######################################################################################################
+# shared http session, so polls reuse kept-alive connections instead of a new TCP+TLS handshake each time
+vaccine_api_session = None
+vaccine_api_session_lock = threading.Lock()
+
+def get_vaccine_api_session():
+  global vaccine_api_session
+  with vaccine_api_session_lock:
+    if vaccine_api_session is None:
+      session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16)
+      session.mount('https://', adapter)
+      session.mount('http://', adapter)
+      vaccine_api_session = session
+  return vaccine_api_session
+
+
+#######################################################################################################
+# threads for hedged requests, so a second copy of a slow request can race the first
+fetch_executor = None
+
+def get_fetch_executor():
+  global fetch_executor
+  with vaccine_api_session_lock:
+    if fetch_executor is None:
+      fetch_executor = futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix='vaccine-api-fetch')
+  return fetch_executor
+
+
+#######################################################################################################
+# how hard to try each vaccine api - override any of these per api with 'fetch_policy' in the vaccine_api
+default_fetch_policy = {
+  'connect_timeout': 5.0,       # seconds to connect before giving up on a request
+  'read_timeout': 15.0,         # seconds to wait on the response between bytes
+  'max_retries': 2,             # extra tries per fetch, while the retry budget allows
+  'retry_backoff': 0.5,         # seconds before the first retry, doubling each retry after
+  'retry_ratio': 0.2,           # retries earned per fetch, so retries stay a fraction of our traffic
+  'max_retry_tokens': 10.0,     # most retries that can be saved up
+  'hedge_after': 5.0,           # send a second copy of a request still waiting after N seconds, 0 is off
+  'failure_threshold': 5,       # failed fetches in a row that open the circuit
+  'reset_timeout': 30.0         # seconds an open circuit waits before letting a trial fetch through
+}
+
+
+#######################################################################################################
+# endpoint guards - per vaccine api (by url) circuit breaker and retry budget. after failure_threshold
+# failed fetches in a row the circuit opens and fetches stop hitting the api, until reset_timeout later a
+# single trial fetch goes through (half open) and closes the circuit again if it works
+endpoint_guards = {}
+endpoint_guards_lock = threading.Lock()
+
+def get_endpoint_guard(vaccine_api):
+  with endpoint_guards_lock:
+    guard = endpoint_guards.get(vaccine_api['url'])
+    if guard is None:
+      guard = endpoint_guards[vaccine_api['url']] = {
+        'state': 'closed',      # closed, open or half_open
+        'failures': 0,          # failed fetches in a row
+        'opened_at': 0.0,       # time.monotonic() the circuit last opened
+        'retry_tokens': default_fetch_policy['max_retry_tokens']
+      }
+    # read every time, so policy edits in a reloaded config take effect
+    guard['policy'] = dict(default_fetch_policy, **vaccine_api.get('fetch_policy', {}))
+  return guard
+
+
+#######################################################################################################
+# can a fetch go through to the api - False while the circuit is open, or half open with a trial in flight
+def endpoint_allows(guard):
+  with endpoint_guards_lock:
+    if guard['state'] == 'closed':
+      return True
+    if guard['state'] == 'open' and time.monotonic() - guard['opened_at'] >= guard['policy']['reset_timeout']:
+      guard['state'] = 'half_open'
+      return True
+    return False
+
+
+#######################################################################################################
+# record how a fetch went, opening or closing the circuit as needed
+def record_endpoint_result(guard, is_success):
+  with endpoint_guards_lock:
+    if is_success:
+      guard['state'] = 'closed'
+      guard['failures'] = 0
+      return
+    guard['failures'] += 1
+    if guard['state'] == 'half_open' or guard['failures'] >= guard['policy']['failure_threshold']:
+      if guard['state'] != 'open':
+        count_metric('circuit_opened')
+      guard['state'] = 'open'
+      guard['opened_at'] = time.monotonic()
+
+
+#######################################################################################################
+# take one retry from the budget, returns False when it is used up
+def spend_retry_token(guard):
+  with endpoint_guards_lock:
+    if guard['retry_tokens'] < 1.0:
+      return False
+    guard['retry_tokens'] -= 1.0
+    return True
+
+
+#######################################################################################################
+# close a response nobody is going to read, e.g. from the slower copy of a hedged request
+def close_unused_response(sent_request):
+  if not sent_request.cancelled() and sent_request.exception() is None:
+    sent_request.result().close()
+
+
+#######################################################################################################
+# GET with timeouts - if it hasn't answered after hedge_after seconds a second copy is sent, and whichever
+# answers first is used. a hedge costs a retry token, so a slow api doesn't get twice the traffic
+def send_hedged_request(guard, url, headers, is_streamed):
+  policy = guard['policy']
+  session = get_vaccine_api_session()
+  def send():
+    return session.get(url, headers=headers, stream=is_streamed, timeout=(policy['connect_timeout'], policy['read_timeout']))
+  if not policy['hedge_after']:
+    return send()
+
+  executor = get_fetch_executor()
+  sent_requests = [executor.submit(send)]
+  done, pending = futures.wait(sent_requests, timeout=policy['hedge_after'])
+  if not done and spend_retry_token(guard):
+    count_metric('fetch_hedged')
+    sent_requests.append(executor.submit(send))
+
+  # first successful answer wins, or the last error if they both fail
+  pending = set(sent_requests)
+  while pending:
+    done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+    winner = next((sent_request for sent_request in done if sent_request.exception() is None), None)
+    if winner is not None:
+      for sent_request in sent_requests:
+        if sent_request is not winner:
+          sent_request.add_done_callback(close_unused_response)
+      return winner.result()
+  return sent_requests[-1].result()
+
+
+#######################################################################################################
+# GET from a vaccine api, retrying connection errors, timeouts, 429s and 5xxs with exponential backoff
+# while the retry budget allows. raises the last error when out of tries
+def send_with_retries(guard, url, headers, is_streamed):
+  policy = guard['policy']
+  with endpoint_guards_lock:
+    guard['retry_tokens'] = min(policy['max_retry_tokens'], guard['retry_tokens'] + policy['retry_ratio'])
+
+  attempt = 0
+  while True:
+    try:
+      response = send_hedged_request(guard, url, headers, is_streamed)
+      if response.status_code >= 400:
+        response.close()
+        raise requests.HTTPError('Vaccine API error ' + str(response.status_code), response=response)
+      return response
+    except requests.RequestException as error:
+      is_retryable = error.response is None or error.response.status_code == 429 or error.response.status_code >= 500
+      if not is_retryable or attempt >= policy['max_retries'] or not spend_retry_token(guard):
+        raise
+    count_metric('fetch_retries')
+    time.sleep(policy['retry_backoff'] * 2 ** attempt * random.uniform(0.5, 1.0))
+    attempt += 1
+
+
+#######################################################################################################
+# what each vaccine API (by url) returned last time - validators for conditional GETs, a hash of the body
+# and the api's own lastUpdated. is_stale is set while the api is failing and we are going on what it last sent
+vaccine_api_cache = {}
+
+
+#######################################################################################################
+# incremental json reader over an iterable of text chunks - decodes one value at a time, so it only ever
+# holds the value being decoded plus the chunk it came in
+json_decoder = json.JSONDecoder()
+
+class JsonChunkReader:
+  def __init__(self, chunks):
+    self.chunks = iter(chunks)
+    self.buffer = ''
+    self.position = 0
+    self.is_eof = False
+
+  # append the next chunk, dropping what has already been decoded
+  def read_more(self):
+    chunk = next(self.chunks, None)
+    if chunk is None:
+      self.is_eof = True
+      return False
+    self.buffer = self.buffer[self.position:] + chunk
+    self.position = 0
+    return True
+
+  # next non-whitespace character, without consuming it
+  def peek(self):
+    while True:
+      while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\n\r':
+        self.position += 1
+      if self.position < len(self.buffer):
+        return self.buffer[self.position]
+      if not self.read_more():
+        raise ValueError('Unexpected end of JSON')
+
+  # consume the next non-whitespace character, which has to be char
+  def expect(self, char):
+    if self.peek() != char:
+      raise ValueError('Expected ' + char + ' in JSON')
+    self.position += 1
+
+  # decode the next complete value, reading more chunks until it is all there
+  def decode_value(self):
+    self.peek()
+    while True:
+      try:
+        value, end = json_decoder.raw_decode(self.buffer, self.position)
+        # a number right at the end of the buffer may carry on in the next chunk
+        if end < len(self.buffer) or self.is_eof:
+          self.position = end
+          return value
+      except json.JSONDecodeError:
+        if self.is_eof:
+          raise
+      self.read_more()
+
+
+#######################################################################################################
+# yield the providers in a streamed vaccine api response one at a time, without building the whole response
+# other top level fields are decoded as they go by, lastUpdated is kept in fetched
+def stream_provider_list(response, vaccine_api, fetched):
+  try:
+    text_decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    reader = JsonChunkReader(text_decoder.decode(chunk) for chunk in response.iter_content(chunk_size=16384))
+    reader.expect('{')
+    is_done = reader.peek() == '}'
+    while not is_done:
+      key = reader.decode_value()
+      reader.expect(':')
+      if key == vaccine_api.get('provider_list_field', 'providerList'):
+        reader.expect('[')
+        is_list_done = reader.peek() == ']'
+        while not is_list_done:
+          provider = reader.decode_value()
+          if __debug__ and vaccine_api.get('debug_dump'):
+            print(json.dumps(provider, sort_keys=True, indent=4))
+          yield provider
+          is_list_done = reader.peek() != ','
+          if not is_list_done:
+            reader.expect(',')
+        reader.expect(']')
+      else:
+        value = reader.decode_value()
+        if key == 'lastUpdated':
+          fetched['last_updated'] = value
+      is_done = reader.peek() != ','
+      if not is_done:
+        reader.expect(',')
+    reader.expect('}')
+  finally:
+    response.close()
+
+
+#######################################################################################################
+# pass a fetch's providers through, and only once every one of them has decoded remember the response as
+# the api's last good one - a body that fails to decode is fetched and decoded again on the next poll,
+# instead of being short-circuited by validators that were never good
+def commit_provider_list(provider_list, vaccine_api, cache, fetched):
+  guard = get_endpoint_guard(vaccine_api)
+  try:
+    yield from provider_list
+  except Exception:
+    record_endpoint_result(guard, False)
+    count_metric('fetch_decode_errors')
+    raise
+  record_endpoint_result(guard, True)
+  cache.update(fetched)
+  cache['is_stale'] = False
+
+
+#######################################################################################################
+# get the providers from the vaccine API as provider records, or None if nothing changed since the last fetch
+# they are decoded by the vaccine_api's 'feed_adapter' as they are iterated. with 'stream': True in the vaccine_api this is a generator that decodes providers as they arrive,
+# so large feeds never sit in memory all at once. either way it has to be iterated to the end to finish the fetch
+# while the api is failing, this also returns None with the cache marked stale - the last good list stands
+def fetch_provider_list(vaccine_api):
+  cache = vaccine_api_cache.setdefault(vaccine_api['url'], {'etag': None, 'last_modified': None, 'body_hash': None, 'last_updated': None, 'is_stale': False})
+  is_streamed = vaccine_api.get('stream', False)
+  guard = get_endpoint_guard(vaccine_api)
+  has_last_good = cache['body_hash'] is not None or cache['etag'] is not None or cache['last_modified'] is not None
+
+  # don't hammer an api whose circuit is open, go on what it last sent
+  if not endpoint_allows(guard):
+    if not has_last_good:
+      raise requests.ConnectionError('Vaccine API circuit open: ' + vaccine_api['url'])
+    cache['is_stale'] = True
+    count_metric('fetch_stale')
+    return None
 
-  def dbg_notification_msg(mail_msg):
+  # only ask for the list if it changed since we last saw it
+  headers = {}
+  if cache['etag']:
+    headers['If-None-Match'] = cache['etag']
+  if cache['last_modified']:
+    headers['If-Modified-Since'] = cache['last_modified']
+
+  # get vaccine availability from API - it may be down here and there, so a failed fetch falls back on
+  # the last good list, and only raises if we never had one
+  try:
+    with time_stage('fetch'):
+      response = send_with_retries(guard, vaccine_api['url'], headers, is_streamed)
+    if response.status_code == 304:
+      response.close()
+    elif not is_streamed:
+      content = response.content
+      # not every api sends validators, so skip decoding a body that is byte-identical to the last one
+      body_hash = hashlib.sha1(content).digest()
+      if body_hash != cache['body_hash']:
+        # expected vaccine api response format - see bottom of file
+        with time_stage('decode'):
+          vaccine_availability_response = response.json()
+          provider_list = vaccine_availability_response[vaccine_api.get('provider_list_field', 'providerList')]
+  except (requests.RequestException, ValueError, KeyError, TypeError):
+    # a body that doesn't decode counts as a failed fetch too
+    record_endpoint_result(guard, False)
+    if not has_last_good:
+      raise
     if __debug__:
-      print('Subject: ' + msg['Subject'])
-      print('From: ' + msg['From'])
-      print('From: ' + msg['From'])
-      print('To: ' + msg['To'])
-      print(msg.as_string())
+      traceback.print_exc()
+    cache['is_stale'] = True
+    count_metric('fetch_stale')
+    return None
 
-  # set up smtp params
-  msg_smtpserver = smtplib.SMTP(msg['smtp_api_url'], msg['smtp_api_port'])
-  msg_smtpserver.ehlo()
-  msg_smtpserver.starttls()
-  msg_smtpserver.ehlo
-  msg_smtpserver.login(msg['mail_user'], msg['mail_password'])
+  if response.status_code == 304:
+    record_endpoint_result(guard, True)
+    cache['is_stale'] = False
+    count_metric('fetch_not_modified')
+    return None
 
-  # fill in message params
-  mail_msg = MIMEText(msg['body'])
-  mail_msg['From'] = msg['mail_user']
-  mail_msg['To'] = msg['to']
-  mail_msg['Subject'] = msg['subject']
-  dbg_notification_msg(mail_msg)
+  fetched = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'), 'last_updated': None}
+
+  # a streamed body is matched as it arrives, so only the validators above can short-circuit it
+  if is_streamed:
+    return commit_provider_list(decode_provider_list(stream_provider_list(response, vaccine_api, fetched), vaccine_api), vaccine_api, cache, fetched)
+
+  if body_hash == cache['body_hash']:
+    record_endpoint_result(guard, True)
+    cache.update(etag=fetched['etag'], last_modified=fetched['last_modified'], is_stale=False)
+    count_metric('fetch_unchanged')
+    return None
+
+  # dumping the whole response is costly, so only when asked for with 'debug_dump': True in the vaccine_api
+  if __debug__ and vaccine_api.get('debug_dump'):
+    print(json.dumps(vaccine_availability_response, sort_keys=True, indent=4))
 
-  # send!
-  msg_smtpserver.sendmail(msg['mail_user'], [msg['to']], mail_msg.as_string())
-  msg_smtpserver.quit()
+  fetched['body_hash'] = body_hash
+  fetched['last_updated'] = vaccine_availability_response.get('lastUpdated')
+  return commit_provider_list(decode_provider_list(provider_list, vaccine_api), vaccine_api, cache, fetched)
 
 
 #######################################################################################################
-# determine if there is availability at any of the desired providers
-def desired_provider_match(provider, desired_provider_id_values, provider_id_field):
-  is_desired_provider_match = any(desired_provider_id for desired_provider_id in desired_provider_id_values if desired_provider_id == provider[provider_id_field])
-  return is_desired_provider_match
+# determine which of the desired providers are showing availability
+def find_desired_available_providers(provider_list, desired_provider_id_values):
+  desired_provider_id_values = set(desired_provider_id_values)
+
+  # providers showing availability that are also the providers we are interested in, in one pass
+  desired_provider_available_list = list(provider for provider in provider_list
+                                         if provider.is_available and desired_provider_match(provider, desired_provider_id_values))
   
+  return desired_provider_available_list
+
 
 #######################################################################################################
 # determine if vaccine is available at desired location
 def check_vaccine_availability(vaccine_api, desired_provider_id_values):
-  is_vaccine_available = False
-  
-  # get vaccine availability from API
-  response = requests.get(vaccine_api['url'])
-  
-  # api may be down here an there, so just log it
-  #if response.status_code != 200:
-  #  print('Vaccine API error')
-  #  if __debug__:
-  #    print(response.text)
-  #  return None
-    
+  provider_list = fetch_provider_list(vaccine_api)
+  if provider_list is None:
+    # nothing changed since the last poll, so nothing new to report
+    return []
+
   # see if the provided we desire has availability
-  # expected vaccine api response format - see bottom of file
-  vaccine_availability_response = response.json()
-  if __debug__:
-    print(json.dumps(vaccine_availability_response, sort_keys=True, indent=4))
+  with time_stage('match'):
+    return find_desired_available_providers(provider_list, desired_provider_id_values)
 
-  # extract which providers are showing availability
-  provider_list = vaccine_availability_response['providerList']
-  available_provider_list = list(provider for provider in provider_list if provider[vaccine_api['available_appointments_field']] == vaccine_api['available_appointments_value'])
-  
-  # see if any providers with availability are the providers we are interested in
-  desired_provider_available_list = list(provider for provider in available_provider_list if desired_provider_match(provider, desired_provider_id_values, vaccine_api['provider_id_field']))
-  
-  return desired_provider_available_list;
+
+#######################################################################################################
+# availability history store - a directory of binary columns, one fixed-size value per row, appended every
+# poll and read back through mmap so queries never load the whole history
+#   polls.time, polls.last_updated - one row per poll: epoch seconds of the poll and of the api's lastUpdated
+#   changes.provider, changes.available, changes.poll - one row each time a provider's availability
+#     changed, with the poll (row in polls.*) it changed on. providers start out unavailable, so each
+#     provider's rows alternate opened, closed, opened, ...
+#   providers.json - the provider id behind each changes.provider number, one json value per line in
+#     the order they were first seen, so any api's ids (strings too) fit the fixed-size column
+# recording only changes keeps a poll where nothing moved down to 8 bytes
+history_columns = {
+  'polls.time': 'I',
+  'polls.last_updated': 'I',
+  'changes.provider': 'I',
+  'changes.available': 'B',
+  'changes.poll': 'I'
+}
+last_updated_format = '%m/%d/%Y, %I:%M:%S %p'   # e.g. 3/18/2021, 6:07:59 PM
+
+
+#######################################################################################################
+# map one column of a history store read-only, as a memoryview of its values
+def map_history_column(path, name):
+  typecode = history_columns[name]
+  column_path = os.path.join(path, name)
+  size = os.path.getsize(column_path) if os.path.exists(column_path) else 0
+  itemsize = array.array(typecode).itemsize
+  if size < itemsize:
+    return memoryview(array.array(typecode))
+  with open(column_path, 'rb') as column_file:
+    mapped = mmap.mmap(column_file.fileno(), 0, access=mmap.ACCESS_READ)
+  # ignore a partly written value at the end, e.g. after a crash mid-append
+  return memoryview(mapped)[:size - size % itemsize].cast(typecode)
+
+
+#######################################################################################################
+# open (or create) the history store in the directory at path
+# keeps the rows to drop once they are older than retention_days, checked every compact_every polls
+def open_history_store(path, retention_days=None, compact_every=2880):
+  os.makedirs(path, exist_ok=True)
+  store = {
+    'path': path,
+    'retention_days': retention_days,
+    'compact_every': compact_every,
+    'poll_count': len(map_history_column(path, 'polls.time')),
+    'provider_ids': [],         # changes.provider number -> provider id
+    'provider_numbers': {},     # provider id -> changes.provider number
+    'states': {},     # changes.provider number -> availability as of the last poll
+    'lock': threading.Lock()
+  }
+  providers_path = os.path.join(path, 'providers.json')
+  if os.path.exists(providers_path):
+    with open(providers_path, 'rb') as providers_file:
+      for line in providers_file:
+        # ignore a partly written line at the end, e.g. after a crash mid-append
+        if line.endswith(b'\n'):
+          store['provider_numbers'][json.loads(line)] = len(store['provider_ids'])
+          store['provider_ids'].append(json.loads(line))
+  # replay the changes to know where every provider stands
+  for provider, available in zip(map_history_column(path, 'changes.provider'), map_history_column(path, 'changes.available')):
+    store['states'][provider] = available
+  return store
+
+
+#######################################################################################################
+# the changes.provider number for each of provider_ids, numbering (and saving) the ones new to the store
+# call with the store's lock held
+def number_history_providers(store, provider_ids):
+  provider_numbers = store['provider_numbers']
+  new_provider_ids = []
+  for provider_id in provider_ids:
+    if provider_id not in provider_numbers:
+      provider_numbers[provider_id] = len(store['provider_ids'])
+      store['provider_ids'].append(provider_id)
+      new_provider_ids.append(provider_id)
+  if new_provider_ids:
+    # saved ahead of any change row that uses the numbers
+    with open(os.path.join(store['path'], 'providers.json'), 'a') as providers_file:
+      providers_file.writelines(json.dumps(provider_id) + '\n' for provider_id in new_provider_ids)
+  return [provider_numbers[provider_id] for provider_id in provider_ids]
+
+
+#######################################################################################################
+# epoch seconds for the api's lastUpdated, or 0 if it is missing or not in the NY format
+def parse_last_updated(last_updated):
+  try:
+    return int(time.mktime(time.strptime(last_updated, last_updated_format)))
+  except (TypeError, ValueError):
+    return 0
+
+
+#######################################################################################################
+# append one poll to the history store
+# provider_ids and available_flags are parallel arrays with every provider in the poll, or None if the
+# api reported nothing changed
+def append_history_snapshot(store, provider_ids, available_flags, poll_time, last_updated):
+  with store['lock']:
+    poll = store['poll_count']
+    states = store['states']
+    changes = {'changes.provider': array.array('I'), 'changes.available': array.array('B'), 'changes.poll': array.array('I')}
+
+    def record_change(provider, available):
+      states[provider] = available
+      changes['changes.provider'].append(provider)
+      changes['changes.available'].append(available)
+      changes['changes.poll'].append(poll)
+
+    if provider_ids is not None:
+      providers = number_history_providers(store, provider_ids)
+      seen_providers = set(providers)
+      for provider, available in zip(providers, available_flags):
+        if states.get(provider, 0) != available:
+          record_change(provider, available)
+      # providers that dropped off the list are no longer available
+      for provider, available in list(states.items()):
+        if available and provider not in seen_providers:
+          record_change(provider, 0)
+
+    columns = dict(changes)
+    columns['polls.time'] = array.array('I', [int(poll_time)])
+    columns['polls.last_updated'] = array.array('I', [parse_last_updated(last_updated)])
+    for name, values in columns.items():
+      if values:
+        with open(os.path.join(store['path'], name), 'ab') as column_file:
+          values.tofile(column_file)
+    store['poll_count'] += 1
+
+  if store['retention_days'] and store['poll_count'] % store['compact_every'] == 0:
+    compact_history_store(store)
+
+
+#######################################################################################################
+# drop polls older than the store's retention_days, rewriting the columns
+# providers open at the cutoff get a change row on the first kept poll, so every provider's rows still
+# start with an opening
+def compact_history_store(store):
+  with store['lock']:
+    path = store['path']
+    cutoff = time.time() - store['retention_days'] * 86400
+    poll_times = map_history_column(path, 'polls.time')
+    first_poll = 0
+    while first_poll < len(poll_times) and poll_times[first_poll] < cutoff:
+      first_poll += 1
+    if first_poll == 0:
+      return
+
+    columns = {name: array.array(typecode) for name, typecode in history_columns.items()}
+    columns['polls.time'].extend(poll_times[first_poll:])
+    columns['polls.last_updated'].extend(map_history_column(path, 'polls.last_updated')[first_poll:])
+    states_at_cutoff = {}
+    for provider, available, poll in zip(map_history_column(path, 'changes.provider'), map_history_column(path, 'changes.available'), map_history_column(path, 'changes.poll')):
+      if poll < first_poll:
+        states_at_cutoff[provider] = available
+        continue
+      if states_at_cutoff:
+        # carry forward who was open at the cutoff, ahead of the first kept change
+        for open_provider, was_available in states_at_cutoff.items():
+          if was_available:
+            columns['changes.provider'].append(open_provider)
+            columns['changes.available'].append(1)
+            columns['changes.poll'].append(0)
+        states_at_cutoff = {}
+      columns['changes.provider'].append(provider)
+      columns['changes.available'].append(available)
+      columns['changes.poll'].append(poll - first_poll)
+    for open_provider, was_available in states_at_cutoff.items():
+      if was_available:
+        columns['changes.provider'].append(open_provider)
+        columns['changes.available'].append(1)
+        columns['changes.poll'].append(0)
+    poll_times = None
+
+    # write every column aside first, then swap them in
+    for name, values in columns.items():
+      with open(os.path.join(path, name + '.tmp'), 'wb') as column_file:
+        values.tofile(column_file)
+    for name in columns:
+      os.replace(os.path.join(path, name + '.tmp'), os.path.join(path, name))
+    store['poll_count'] = len(columns['polls.time'])
+
+
+#######################################################################################################
+# when was a provider last available - returns a datetime, or None if it never was
+# without a provider_id, returns {provider id: that} for every provider in the store, in one pass
+def history_last_available(store, provider_id=None):
+  path = store['path']
+  poll_times = map_history_column(path, 'polls.time')
+  providers = map_history_column(path, 'changes.provider')
+  available = map_history_column(path, 'changes.available')
+  polls = map_history_column(path, 'changes.poll')
+  # a change row being appended is only there once all its columns are
+  change_count = min(len(providers), len(available), len(polls))
+
+  # the last change row of each provider asked about - rows are in time order
+  last_rows = {}
+  if provider_id is not None:
+    provider = store['provider_numbers'].get(provider_id)
+    for row in range(change_count - 1, -1, -1):
+      if providers[row] == provider:
+        last_rows[provider] = row
+        break
+  else:
+    for row, provider in enumerate(providers[:change_count]):
+      last_rows[provider] = row
+
+  last_available = {}
+  for provider, row in last_rows.items():
+    if available[row]:
+      # still open as of the latest poll
+      last_available[store['provider_ids'][provider]] = datetime.datetime.fromtimestamp(poll_times[-1]) if len(poll_times) else None
+    else:
+      # it closed on this poll, so the poll before was the last time it was open
+      poll = min(polls[row], len(poll_times))
+      last_available[store['provider_ids'][provider]] = datetime.datetime.fromtimestamp(poll_times[poll - 1]) if poll else None
+  if provider_id is not None:
+    return last_available.get(provider_id)
+  return last_available
+
+
+#######################################################################################################
+# fraction of polls in each hour of the day (0-23) that each provider was available for
+# returns {provider id: list of 24 rates}
+def history_hourly_open_rate(store):
+  path = store['path']
+  poll_hours = array.array('B', (time.localtime(poll_time).tm_hour for poll_time in map_history_column(path, 'polls.time')))
+  polls_by_hour = [0] * 24
+  for hour in poll_hours:
+    polls_by_hour[hour] += 1
+
+  # walk each provider's open intervals, from an opening up to the next closing (or the latest poll)
+  # change rows are written ahead of their poll's row, so a store being written can have a few too many
+  open_polls_by_hour = {}
+  opened_at = {}
+  for provider, available, poll in zip(map_history_column(path, 'changes.provider'), map_history_column(path, 'changes.available'), map_history_column(path, 'changes.poll')):
+    if poll >= len(poll_hours):
+      break
+    open_polls = open_polls_by_hour.setdefault(provider, [0] * 24)
+    if available:
+      opened_at[provider] = poll
+    elif provider in opened_at:
+      for hour in poll_hours[opened_at.pop(provider):poll]:
+        open_polls[hour] += 1
+  for provider, poll in opened_at.items():
+    for hour in poll_hours[poll:]:
+      open_polls_by_hour[provider][hour] += 1
+
+  return {store['provider_ids'][provider]: [open_polls[hour] / polls_by_hour[hour] if polls_by_hour[hour] else 0.0 for hour in range(24)]
+          for provider, open_polls in open_polls_by_hour.items()}
+
+
+#######################################################################################################
+# numpy, when it is installed, for the history analytics - None when it isn't
+def import_numpy():
+  try:
+    return importlib.import_module('numpy')
+  except ImportError:
+    return None
+
+
+#######################################################################################################
+# when each provider tends to open - the openings in a history store counted by time of day, in windows of
+# bin_minutes, plus how long openings last. openings on a store's first poll are left out, since those
+# providers were already open when recording started
+# returns {'bin_minutes': bin_minutes, 'providers': {provider id: {'openings': count per window,
+#          'opening_count': total openings, 'mean_open_seconds': average time open, or None if none closed yet}}}
+def history_opening_distribution(store, bin_minutes=15):
+  path = store['path']
+  poll_times = map_history_column(path, 'polls.time')
+  providers = map_history_column(path, 'changes.provider')
+  provider_ids = store['provider_ids']
+  available = map_history_column(path, 'changes.available')
+  polls = map_history_column(path, 'changes.poll')
+  bin_count = 1440 // bin_minutes
+  # each poll's own utc offset, so openings either side of a daylight saving change land in the right window
+  utc_offsets = array.array('i', (time.localtime(poll_time).tm_gmtoff for poll_time in poll_times))
+  # change rows are appended a column at a time and ahead of their poll's row, so a store being written can
+  # have a few rows that aren't complete or whose poll isn't recorded yet - those are left out
+  change_count = min(len(providers), len(available), len(polls))
+
+  numpy = import_numpy()
+  if numpy is not None and change_count:
+    # vectorized - every change's time and window in one go, then counts per (provider, window)
+    change_polls = numpy.asarray(polls[:change_count])
+    is_recorded = change_polls < len(poll_times)
+    change_polls = change_polls[is_recorded]
+    change_times = numpy.asarray(poll_times).astype(numpy.int64)[change_polls]
+    change_offsets = numpy.asarray(utc_offsets)[change_polls]
+    is_available = numpy.asarray(available[:change_count]).astype(bool)[is_recorded]
+    unique_providers, provider_index = numpy.unique(numpy.asarray(providers[:change_count])[is_recorded], return_inverse=True)
+    is_opening = is_available & (change_polls > 0)
+    bins = (change_times + change_offsets) % 86400 // (bin_minutes * 60)
+    openings = numpy.bincount(provider_index[is_opening] * bin_count + bins[is_opening], minlength=len(unique_providers) * bin_count).reshape(len(unique_providers), bin_count)
+
+    # each provider's changes alternate opened, closed, ... in time order, so after a stable sort by
+    # provider an opening followed by a closing of the same provider is one time it was open
+    order = numpy.argsort(provider_index, kind='stable')
+    provider_index, is_available, is_opening, change_times = provider_index[order], is_available[order], is_opening[order], change_times[order]
+    is_interval = is_opening[:-1] & ~is_available[1:] & (provider_index[:-1] == provider_index[1:])
+    open_seconds = numpy.bincount(provider_index[:-1][is_interval], weights=change_times[1:][is_interval] - change_times[:-1][is_interval], minlength=len(unique_providers))
+    closed_counts = numpy.bincount(provider_index[:-1][is_interval], minlength=len(unique_providers))
+    return {'bin_minutes': bin_minutes, 'providers': {provider_ids[provider]: {
+      'openings': openings[i].tolist(),
+      'opening_count': int(openings[i].sum()),
+      'mean_open_seconds': float(open_seconds[i] / closed_counts[i]) if closed_counts[i] else None
+    } for i, provider in enumerate(unique_providers.tolist())}}
+
+  # one pass over the changes with plain arrays
+  openings = {}
+  open_seconds = {}
+  closed_counts = {}
+  opened_at = {}    # provider -> time of its current opening, or None for one we didn't see happen
+  for provider, is_available, poll in zip(providers, available, polls):
+    if poll >= len(poll_times):
+      continue
+    change_time = poll_times[poll]
+    provider_openings = openings.get(provider)
+    if provider_openings is None:
+      provider_openings = openings[provider] = array.array('I', bytes(4 * bin_count))
+    if is_available:
+      opened_at[provider] = change_time if poll else None
+      if poll:
+        provider_openings[(change_time + utc_offsets[poll]) % 86400 // (bin_minutes * 60)] += 1
+    elif opened_at.get(provider) is not None:
+      open_seconds[provider] = open_seconds.get(provider, 0) + change_time - opened_at.pop(provider)
+      closed_counts[provider] = closed_counts.get(provider, 0) + 1
+  return {'bin_minutes': bin_minutes, 'providers': {provider_ids[provider]: {
+    'openings': provider_openings.tolist(),
+    'opening_count': sum(provider_openings),
+    'mean_open_seconds': open_seconds[provider] / closed_counts[provider] if provider in closed_counts else None
+  } for provider, provider_openings in openings.items()}}
+
+
+#######################################################################################################
+# the time of day windows sites are likely to open in - ones that saw at least min_openings openings and
+# at least twice their share, across every provider in the distribution
+def forecast_opening_windows(distribution, min_openings=3):
+  bin_count = 1440 // distribution['bin_minutes']
+  openings = [0] * bin_count
+  for provider in distribution['providers'].values():
+    for window, count in enumerate(provider['openings']):
+      openings[window] += count
+  threshold = max(min_openings, 2 * sum(openings) / bin_count)
+  return [window for window, count in enumerate(openings) if count >= threshold]
+
+
+#######################################################################################################
+# forecast a vaccine api's likely opening windows from its history store, at most every forecast_frequency
+def refresh_poll_forecast(schedule, vaccine_api):
+  if 'history_path' not in vaccine_api:
+    return
+  if schedule['forecast_at'] is not None and time.monotonic() - schedule['forecast_at'] < schedule['forecast_frequency']:
+    return
+  schedule['forecast_at'] = time.monotonic()
+  with time_stage('forecast'):
+    distribution = history_opening_distribution(get_history_store(vaccine_api), schedule['window_minutes'])
+  schedule['likely_windows'] = set(forecast_opening_windows(distribution))
+
+
+#######################################################################################################
+# the time of day window as text, e.g. 08:15-08:30
+def format_window(window, bin_minutes):
+  start = window * bin_minutes
+  end = start + bin_minutes
+  return '%02d:%02d-%02d:%02d' % (start // 60, start % 60, end // 60 % 24, end % 60)
+
+
+#######################################################################################################
+# report of the best windows to catch each provider, busiest providers first
+# e.g. 1003: 42 openings, open 18 min on average - 08:00-08:15 31%, 14:00-14:15 12%, 17:45-18:00 7%
+# with last_available and open_rates (see history_last_available, history_hourly_open_rate) each line also gets
+# e.g. - last open 2021-03-02 08:14, open most at 08:00 (41% of polls)
+def format_history_report(distribution, top_windows=3, last_available=None, open_rates=None):
+  lines = []
+  bin_minutes = distribution['bin_minutes']
+  for provider_id, provider in sorted(distribution['providers'].items(), key=lambda item: -item[1]['opening_count']):
+    if not provider['opening_count']:
+      continue
+    line = str(provider_id) + ': ' + str(provider['opening_count']) + ' openings'
+    if provider['mean_open_seconds'] is not None:
+      line += ', open ' + str(round(provider['mean_open_seconds'] / 60)) + ' min on average'
+    windows = sorted(range(len(provider['openings'])), key=lambda window: -provider['openings'][window])[:top_windows]
+    line += ' - ' + ', '.join(format_window(window, bin_minutes) + ' ' + str(round(100 * provider['openings'][window] / provider['opening_count'])) + '%'
+                              for window in windows if provider['openings'][window])
+    if last_available and last_available.get(provider_id):
+      line += ' - last open ' + last_available[provider_id].strftime('%Y-%m-%d %H:%M')
+    if open_rates and provider_id in open_rates:
+      hour = max(range(24), key=lambda hour: open_rates[provider_id][hour])
+      line += (', ' if last_available else ' - ') + 'open most at %02d:00 (' % hour + str(round(100 * open_rates[provider_id][hour])) + '% of polls)'
+    lines.append(line)
+  return '\n'.join(lines)
+
+
+#######################################################################################################
+# history stores by vaccine api url, for apis with a 'history_path'
+history_stores = {}
+history_stores_lock = threading.Lock()
+
+def get_history_store(vaccine_api):
+  with history_stores_lock:
+    if vaccine_api['url'] not in history_stores:
+      history_stores[vaccine_api['url']] = open_history_store(vaccine_api['history_path'], vaccine_api.get('history_retention_days'))
+    return history_stores[vaccine_api['url']]
+
+
+#######################################################################################################
+# pass providers through while noting each one's id and availability, for the history store
+def collect_provider_states(provider_list, provider_ids, available_flags):
+  for provider in provider_list:
+    provider_ids.append(provider.provider_id)
+    available_flags.append(provider.is_available)
+    yield provider
+
+
+#######################################################################################################
+# fetch a vaccine api and diff it against the snapshot
+# returns (whether a new provider list came back, list of providers that opened, list of providers that closed)
+# with a 'history_path' in the vaccine_api, the poll is also recorded in that history store
+def fetch_availability_changes(vaccine_api, snapshot):
+  poll_time = time.time()
+  provider_list = fetch_provider_list(vaccine_api)
+  if provider_list is None and vaccine_api_cache[vaccine_api['url']]['is_stale']:
+    # the api is failing, so we learned nothing this poll - don't count it towards any debounce
+    return False, [], []
+  is_recorded = 'history_path' in vaccine_api
+  if is_recorded and provider_list is not None:
+    provider_ids = []
+    available_flags = array.array('B')
+    provider_list = collect_provider_states(provider_list, provider_ids, available_flags)
+
+  # a streamed provider list is decoded as it is diffed, so for those this includes the decoding
+  with time_stage('diff'):
+    opened_provider_list, closed_provider_list = diff_availability(snapshot, provider_list)
+
+  if is_recorded:
+    if provider_list is None:
+      provider_ids = available_flags = None
+    with time_stage('history'):
+      append_history_snapshot(get_history_store(vaccine_api), provider_ids, available_flags, poll_time, vaccine_api_cache[vaccine_api['url']]['last_updated'])
+  return provider_list is not None, opened_provider_list, closed_provider_list
+
+
+#######################################################################################################
+# sent notification log - an append-only file of json lines, so a daemon that restarts doesn't alert anyone
+# twice for the same opening. each line is one of
+#   {"event": "sent", "subscriber": name, "url": api url, "provider": [id, name, vaccine brand, address], "time": t}
+#   {"event": "closed", "url": api url, "provider_id": id, "time": t}
+# a provider's sent lines count until it closes, after which a new opening alerts again. the log is replayed
+# into a dict on open, so checking it is one lookup however long it gets
+# alerts are only logged as sent once a sink has delivered them - ones still queued are tracked in memory,
+# so an alert lost to a crash goes out again after a restart, and one lost to failed sends or a full queue
+# goes out again on a later poll (see take_failed_notifications()) or after a restart
+def open_sent_log(path, compact_ratio=4):
+  sent_log = {
+    'path': path,
+    'sent': {},             # (url, provider id) -> set of names of subscribers alerted for the current opening
+    'queued': {},           # (url, provider id) -> set of names of subscribers with an alert on its way
+    'failed': {},           # url -> set of names of subscribers with an alert that didn't get through
+    'providers': {},        # (url, provider id) -> [id, name, vaccine brand, address] as last alerted
+    'line_count': 0,
+    'lock': threading.Lock()    # deliveries are recorded from the sinks' threads
+  }
+  if os.path.exists(path):
+    with open(path) as log_file:
+      for line in log_file:
+        try:
+          event = json.loads(line)
+        except ValueError:
+          continue    # a line cut short by a crash
+        sent_log['line_count'] += 1
+        if event['event'] == 'sent':
+          key = (event['url'], event['provider'][0])
+          sent_log['sent'].setdefault(key, set()).add(event['subscriber'])
+          sent_log['providers'][key] = event['provider']
+        elif event['event'] == 'closed':
+          key = (event['url'], event['provider_id'])
+          sent_log['sent'].pop(key, None)
+          sent_log['providers'].pop(key, None)
+
+  # closed openings are dead weight, so rewrite the log with just the live ones once they are most of it
+  live_count = sum(len(names) for names in sent_log['sent'].values())
+  if sent_log['line_count'] > compact_ratio * max(live_count, 256):
+    compact_path = path + '.compact'
+    with open(compact_path, 'w') as log_file:
+      for (url, provider_id), names in sent_log['sent'].items():
+        for name in sorted(names):
+          log_file.write(json.dumps({'event': 'sent', 'subscriber': name, 'url': url, 'provider': sent_log['providers'][(url, provider_id)], 'time': 0}) + '\n')
+      log_file.flush()
+      os.fsync(log_file.fileno())
+    os.replace(compact_path, path)
+    sent_log['line_count'] = live_count
+
+  sent_log['file'] = open(path, 'a')
+  return sent_log
+
+
+#######################################################################################################
+# append events to the sent log and make sure they are on disk before we act on them
+def append_sent_log(sent_log, events):
+  sent_log['file'].write(''.join(json.dumps(event) + '\n' for event in events))
+  sent_log['file'].flush()
+  os.fsync(sent_log['file'].fileno())
+  sent_log['line_count'] += len(events)
+
+
+#######################################################################################################
+# was this subscriber already alerted about this opening of the provider, or is an alert on its way
+def is_notification_sent(sent_log, subscriber_name, url, provider):
+  key = (url, provider.provider_id)
+  with sent_log['lock']:
+    return subscriber_name in sent_log['sent'].get(key, ()) or subscriber_name in sent_log['queued'].get(key, ())
+
+
+#######################################################################################################
+# record that an alert to a subscriber about these providers is on its way
+def record_notification_queued(sent_log, subscriber_name, url, provider_list):
+  with sent_log['lock']:
+    for provider in provider_list:
+      sent_log['queued'].setdefault((url, provider.provider_id), set()).add(subscriber_name)
+
+
+#######################################################################################################
+# record how a queued alert went - delivered ones are logged as sent, failed ones can be sent again
+# an alert that lands after its provider closed is left out, so it doesn't hold back the next opening
+def record_notification_delivered(sent_log, subscriber_name, url, provider_list, is_delivered):
+  now = time.time()
+  events = []
+  with sent_log['lock']:
+    for provider in provider_list:
+      key = (url, provider.provider_id)
+      queued_names = sent_log['queued'].get(key)
+      if queued_names is None or subscriber_name not in queued_names:
+        continue
+      queued_names.discard(subscriber_name)
+      if not queued_names:
+        del sent_log['queued'][key]
+      if not is_delivered:
+        sent_log['failed'].setdefault(url, set()).add(subscriber_name)
+      else:
+        sent_log['sent'].setdefault(key, set()).add(subscriber_name)
+        sent_log['providers'][key] = [provider.provider_id, provider.name, provider.vaccine_brand, provider.address]
+        events.append({'event': 'sent', 'subscriber': subscriber_name, 'url': url, 'provider': sent_log['providers'][key], 'time': now})
+    if events:
+      append_sent_log(sent_log, events)
+
+
+#######################################################################################################
+# names of the subscribers to an api whose alerts failed since we last asked - to match against what is
+# still open and try again
+def take_failed_notifications(sent_log, url):
+  with sent_log['lock']:
+    return sent_log['failed'].pop(url, set())
+
+
+#######################################################################################################
+# record that providers closed, so their next opening alerts again
+def record_providers_closed(sent_log, url, provider_list):
+  now = time.time()
+  events = []
+  with sent_log['lock']:
+    for provider in provider_list:
+      key = (url, provider.provider_id)
+      sent_log['queued'].pop(key, None)
+      if sent_log['sent'].pop(key, None) is not None:
+        del sent_log['providers'][key]
+        events.append({'event': 'closed', 'url': url, 'provider_id': provider.provider_id, 'time': now})
+    if events:
+      append_sent_log(sent_log, events)
+
+
+#######################################################################################################
+# availability snapshots picking up where the log left off - the providers we alerted about and haven't
+# seen close count as available, so after a restart the ones still open aren't news, and the ones that
+# closed while we were down are reported closed as usual
+def restore_availability_snapshots(sent_log):
+  snapshots = {}
+  for (url, provider_id), (provider_id, name, vaccine_brand, address) in sent_log['providers'].items():
+    provider = ProviderRecord(intern_provider_key(url, provider_id), provider_id, name, vaccine_brand, address, True)
+    snapshots.setdefault(url, create_availability_snapshot())['available'][provider.key] = provider
+  return snapshots
+
+
+#######################################################################################################
+def close_sent_log(sent_log):
+  sent_log['file'].close()
 
 
 #######################################################################################################
-# watch for vaccine availability until we find it
-def watch_for_vaccine_availability(vaccine_api, desired_provider_id_values, counter):
-  check_frequency = 30.0     # check availability every N seconds
-  is_vaccine_available = False
+# poll one vaccine api and fan any newly opened providers out to every subscriber watching it
+# returns (whether the api's data changed, how many providers opened or closed)
+async def poll_vaccine_api(vaccine_api, subscription_index, snapshot, on_match, on_close, semaphore):
+  # fetch once per cycle - the semaphore caps how many fetches are in flight across all apis
+  # only transitions matter - a site that stays open is not news. diffing happens with the fetch, so a
+  # streamed provider list is diffed as it arrives
+  last_updated = vaccine_api_cache.get(vaccine_api['url'], {}).get('last_updated')
+  async with semaphore:
+    is_fetched, opened_provider_list, closed_provider_list = await asyncio.to_thread(fetch_availability_changes, vaccine_api, snapshot)
+  is_changed = is_poll_changed(vaccine_api['url'], is_fetched, last_updated)
+
+  transition_count = len(opened_provider_list) + len(closed_provider_list)
+  if closed_provider_list and on_close:
+    await on_close(vaccine_api, closed_provider_list)
+  if not opened_provider_list:
+    return is_changed, transition_count
+
+  # on_match returns True once a subscriber is done and no longer needs to be watched
+  with time_stage('match'):
+    matches = match_subscriptions(subscription_index, opened_provider_list)
+  for name, desired_provider_available_list in matches.items():
+    if await on_match(subscription_index['subscribers'][name], desired_provider_available_list):
+      remove_subscription(subscription_index, name)
+
+  return is_changed, transition_count
 
-  while (not is_vaccine_available):
-    time.sleep(check_frequency)
 
+#######################################################################################################
+# keep polling one vaccine api until none of its subscribers are left
+# take_retries(url), if given, returns the names of subscribers to match again against what is open after
+# each poll, e.g. those whose alerts failed
+async def watch_vaccine_api(vaccine_api, subscription_index, snapshot, on_match, on_close, semaphore, check_frequency, take_retries=None):
+  schedule = create_poll_schedule(**dict({'check_frequency': check_frequency}, **vaccine_api.get('poll_schedule', {})))
+  counter = 0
+  # keep going through errors - fetches retry and fall back on the last good list, and failed polls back
+  # off no further than the schedule's max_frequency, so we are never more than that from seeing it recover
+  while subscription_index['subscribers']:
     # just print the count of times we have checked so we know the script is still running
     counter += 1
-    print('#' + str(counter))
+    print(vaccine_api['url'] + ' #' + str(counter))
+
+    poll_started = time.monotonic()
+    try:
+      await asyncio.to_thread(refresh_poll_forecast, schedule, vaccine_api)
+      with time_stage('poll'):
+        is_changed, transition_count = await poll_vaccine_api(vaccine_api, subscription_index, snapshot, on_match, on_close, semaphore)
+      record_poll_result(schedule, False, is_changed, transition_count)
+      count_metric('polls')
+      for name in take_retries(vaccine_api['url']) if take_retries else ():
+        if name in subscription_index['subscribers']:
+          await match_open_providers(subscription_index['subscribers'][name], subscription_index, snapshot, on_match)
+    except Exception:
+      count_metric('poll_errors')
+      record_poll_result(schedule, True)
+      if __debug__:
+        traceback.print_exc()
 
-    desired_provider_available_list = check_vaccine_availability(vaccine_api, desired_provider_id_values)
-    is_vaccine_available = bool(desired_provider_available_list)  # is list empty or not
+    if subscription_index['subscribers']:
+      await asyncio.sleep(next_poll_delay(schedule, time.monotonic() - poll_started))
 
-  return desired_provider_available_list
+
+#######################################################################################################
+# start watching for a subscriber - the api it watches gets its own poll loop if it doesn't have one running
+# watcher holds the running state of watch_all_for_vaccine_availability()
+# a subscriber that is already done stays done, even if a reload edits it
+def watch_subscriber(watcher, subscriber):
+  if subscriber['name'] in watcher['done_names']:
+    return
+  url = subscriber['vaccine_api']['url']
+  # subscribers of the same api share one vaccine_api, so settings changed on reload reach every one
+  subscriber['vaccine_api'] = vaccine_api = watcher['vaccine_apis'].setdefault(url, subscriber['vaccine_api'])
+  subscription_index = watcher['subscription_indexes'].setdefault(url, create_subscription_index())
+  snapshot = watcher['snapshots'].setdefault(url, create_availability_snapshot())
+  add_subscription(subscription_index, subscriber)
+
+  # someone joining while sites are already open hears about those right away, without waiting for a fetch
+  if snapshot['available']:
+    asyncio.ensure_future(match_open_providers(subscriber, subscription_index, snapshot, watcher['on_match']))
+
+  task = watcher['tasks'].get(url)
+  if task is None or task.done():
+    watcher['tasks'][url] = asyncio.ensure_future(watch_vaccine_api(vaccine_api, subscription_index, snapshot, watcher['on_match'], watcher['on_close'], watcher['semaphore'], watcher['check_frequency'],
+                                                                             watcher['take_retries']))
 
 
 #######################################################################################################
-def main():
-  # define vaccine api parameters and constants
-  vaccine_api = {
-    'url': 'https://am-i-eligible.covid19vaccine.health.ny.gov/api/list-providers',   # NY state vaccine API url
-    'provider_id_field': 'providerId',        # name of the field for the provider's ID
-    'available_appointments_field': 'availableAppointments',    # name of the field for the available appointments
-    'available_appointments_value': 'Y',      # the code in the API for a provder with availability
-    'provider_name_field': 'providerName'     # name of the field for the provider's name
+# match a newly watched subscriber against the providers already open
+async def match_open_providers(subscriber, subscription_index, snapshot, on_match):
+  desired_provider_available_list = match_subscriptions(build_subscription_index([subscriber]), snapshot['available'].values()).get(subscriber['name'])
+  if desired_provider_available_list and subscription_index['subscribers'].get(subscriber['name']) is subscriber:
+    if await on_match(subscriber, desired_provider_available_list):
+      remove_subscription(subscription_index, subscriber['name'])
+
+
+#######################################################################################################
+# stop watching for a subscriber, if we still are
+def unwatch_subscriber(watcher, subscriber):
+  subscription_index = watcher['subscription_indexes'].get(subscriber['vaccine_api']['url'])
+  if subscription_index and subscriber['name'] in subscription_index['subscribers']:
+    remove_subscription(subscription_index, subscriber['name'])
+
+
+#######################################################################################################
+# bring a running watcher in line with an edited config - only subscribers that were added, removed or
+# changed touch the subscription indexes, so a small edit to a big config is cheap
+def apply_config_changes(watcher, config, new_config):
+  # api settings are updated in place, running poll loops pick them up on their next poll
+  for vaccine_api in new_config['vaccine_apis'].values():
+    watched_vaccine_api = watcher['vaccine_apis'].get(vaccine_api['url'])
+    if watched_vaccine_api is not None and watched_vaccine_api != vaccine_api:
+      watched_vaccine_api.update(vaccine_api)
+
+  subscriber_entries = config['subscriber_entries']
+  new_subscriber_entries = new_config['subscriber_entries']
+  for name, entry in subscriber_entries.items():
+    if new_subscriber_entries.get(name) != entry:
+      unwatch_subscriber(watcher, config['subscribers'][name])
+  for name, entry in new_subscriber_entries.items():
+    if subscriber_entries.get(name) != entry:
+      watch_subscriber(watcher, new_config['subscribers'][name])
+
+
+#######################################################################################################
+# check the config file every reload_frequency seconds and apply any edits to the running watcher
+# a config that fails to load is reported and skipped, we keep going with the last good one
+async def watch_config_file(watcher, config_path, config, on_reload=None, reload_frequency=5.0):
+  modified_time = os.stat(config_path).st_mtime
+  while True:
+    await asyncio.sleep(reload_frequency)
+    try:
+      new_modified_time = os.stat(config_path).st_mtime
+      if new_modified_time == modified_time:
+        continue
+      modified_time = new_modified_time
+      new_config = load_config(config_path)
+    except Exception:
+      print('Could not reload ' + config_path + ', keeping the current config')
+      if __debug__:
+        traceback.print_exc()
+      continue
+
+    apply_config_changes(watcher, config, new_config)
+    if on_reload:
+      on_reload(new_config)
+    config = watcher['config'] = new_config
+    print('Reloaded ' + config_path)
+
+
+#######################################################################################################
+# is there nothing left to watch for - every poll loop has finished and every subscriber in the config is done
+def is_watcher_done(watcher):
+  return all(task.done() for task in watcher['tasks'].values()) and all(name in watcher['done_names'] for name in watcher['config']['subscribers'])
+
+
+#######################################################################################################
+# watch many vaccine apis for many subscribers in one event loop, until every subscriber is done
+# each subscriber is a dict with a unique 'name', 'vaccine_api', 'desired_provider_id_values' and/or
+# 'desired_field_values', and 'msg' - see main()
+# on_match(subscriber, providers) is called when providers a subscriber wants open up, and
+# on_close(vaccine_api, providers) when providers stop showing availability
+# a vaccine_api can tune its polling with 'poll_schedule' - keyword arguments for create_poll_schedule()
+# with a config (as loaded from config_path by load_config()) edits to the file are applied as they
+# happen and on_reload(new config) is called, and watching goes on until every subscriber in the latest
+# config is done - for subscribers that are never done (on_match always False), until cancelled
+# snapshots ({url: availability snapshot}, e.g. from restore_availability_snapshots()) seeds what each api
+# was last seen as, so only changes since then count
+# take_retries(url) (see watch_vaccine_api()) picks out subscribers to match again after each poll of an api
+async def watch_all_for_vaccine_availability(subscribers, on_match, on_close=None, check_frequency=30.0, max_concurrency=8, config_path=None, config=None, on_reload=None,
+                                             snapshots=None, take_retries=None):
+  # note who is done, so a reload doesn't start watching them again
+  async def on_match_until_done(subscriber, desired_provider_available_list):
+    is_done = await on_match(subscriber, desired_provider_available_list)
+    if is_done:
+      watcher['done_names'].add(subscriber['name'])
+    return is_done
+
+  watcher = {
+    'vaccine_apis': {},             # url -> vaccine_api
+    'subscription_indexes': {},     # url -> subscription index
+    'snapshots': dict(snapshots or {}),   # url -> availability snapshot, to pick up where a previous run left off
+    'tasks': {},                    # url -> poll loop
+    'done_names': set(),            # subscribers on_match said were done
+    'on_match': on_match_until_done,
+    'on_close': on_close,
+    'take_retries': take_retries,
+    'semaphore': asyncio.Semaphore(max_concurrency),   # caps how many fetches are in flight across all apis
+    'check_frequency': check_frequency,
+    'config': config                # the config as last loaded, when watching a config file
   }
+  # each api is fetched only once per cycle, however many subscribers watch it
+  for subscriber in subscribers:
+    watch_subscriber(watcher, subscriber)
 
-  # list of providers that are close to you, by provider ID (see API)
-  desired_provider_id_values = [1000, 1004, 1019]     # !!! CHANGE BEFORE USE !!! - see providerIDs in expected vaccine api response format below
-  
-  # define notification msg parameters and constants
-  msg = {
-    'to': 'TBD',              # !!! CHANGE BEFORE USE !!! - who this notification message is to
-    'mail_user': 'TBD',       # !!! CHANGE BEFORE USE !!! - who this notification message is from
-    'mail_password': 'TBD',   # !!! CHANGE BEFORE USE !!! - password for email account
-    'smtp_api_url': 'TBD',    # !!! CHANGE BEFORE USE !!! - SMTP url - update code as desired to support other email providers
-    'smtp_api_port': 0,       # !!! CHANGE BEFORE USE !!! - SMTP port
-    'subject': 'Alert - NY vaccine available',    # subject of notification message
-    'body' : ''
+  if config_path:
+    # race the config watcher against the poll loops - a reload can start new loops, so look again at least
+    # once per reload
+    reload_frequency = config['settings']['reload_frequency']
+    config_task = asyncio.ensure_future(watch_config_file(watcher, config_path, config, on_reload, reload_frequency))
+    try:
+      while not is_watcher_done(watcher):
+        await asyncio.wait([config_task, *(task for task in watcher['tasks'].values() if not task.done())], timeout=reload_frequency,
+                           return_when=asyncio.FIRST_COMPLETED)
+        if config_task.done():
+          config_task.result()
+    finally:
+      config_task.cancel()
+  else:
+    await asyncio.gather(*watcher['tasks'].values())
+
+
+#######################################################################################################
+# check every vaccine api once, right away, and alert each subscriber to whatever they want that is open -
+# for cron and other one-shot runs, so no event loop and no waiting. on_match(subscriber, providers) and
+# on_close(vaccine_api, providers) are plain functions here. snapshots (see restore_availability_snapshots())
+# is what earlier runs saw open, so providers that closed since then are reported to on_close
+def check_all_for_vaccine_availability(subscribers, on_match, on_close=None, snapshots=None):
+  subscribers_by_url = {}
+  for subscriber in subscribers:
+    subscribers_by_url.setdefault(subscriber['vaccine_api']['url'], []).append(subscriber)
+
+  for url, url_subscribers in subscribers_by_url.items():
+    vaccine_api = url_subscribers[0]['vaccine_api']
+    # there is only the one poll to go on, so don't wait for a second to confirm anything
+    snapshot = (snapshots or {}).get(url) or create_availability_snapshot()
+    snapshot['open_debounce'] = snapshot['close_debounce'] = 1
+    try:
+      with time_stage('poll'):
+        is_fetched, opened_provider_list, closed_provider_list = fetch_availability_changes(vaccine_api, snapshot)
+      count_metric('polls')
+    except Exception:
+      count_metric('poll_errors')
+      print('Could not check ' + url)
+      if __debug__:
+        traceback.print_exc()
+      continue
+
+    if closed_provider_list and on_close:
+      on_close(vaccine_api, closed_provider_list)
+    # everyone hears about everything open, not just what opened since the last run - on_match can
+    # skip what it already sent
+    subscription_index = build_subscription_index(url_subscribers)
+    with time_stage('match'):
+      matches = match_subscriptions(subscription_index, snapshot['available'].values())
+    for name, desired_provider_available_list in matches.items():
+      on_match(subscription_index['subscribers'][name], desired_provider_available_list)
+
+
+#######################################################################################################
+# settings for the NY state vaccine API - also the defaults for any vaccine api in a config file
+ny_vaccine_api = {
+  'url': 'https://am-i-eligible.covid19vaccine.health.ny.gov/api/list-providers',   # NY state vaccine API url
+  'provider_id_field': 'providerId',        # name of the field for the provider's ID
+  'available_appointments_field': 'availableAppointments',    # name of the field for the available appointments
+  'available_appointments_value': 'Y',      # the code in the API for a provder with availability
+  'provider_name_field': 'providerName',    # name of the field for the provider's name
+  'feed_adapter': 'ny'                      # how to decode its providers, see feed_adapters
+}
+
+# vaccine_api settings the 'ny' feed adapter has built in - an api that sets any of them differently is
+# decoded by the 'fields' adapter, which reads them
+ny_feed_settings = ('provider_id_field', 'available_appointments_field', 'available_appointments_value', 'provider_name_field', 'vaccine_brand_field', 'address_field')
+
+# defaults for the top level settings in a config file
+default_settings = {
+  'subject': 'Alert - NY vaccine available',    # subject of notification messages
+  'message_format': 'email',        # how to lay out messages, see message_formats - 'sms' keeps them to a text's length
+  'check_frequency': 30.0,          # normal seconds between polls of each api
+  'max_concurrency': 8,             # most api fetches in flight at once
+  'worker_count': 0,                # processes to shard subscribers over, 0 watches everyone in this process
+  'metrics_port': 0,                # serve metrics at http://127.0.0.1:<port>/metrics, 0 is off
+  'metrics_dump_frequency': 300.0,  # print a metrics summary every N seconds, 0 is off
+  'reload_frequency': 5.0,          # check the config file for edits every N seconds
+  'gazetteer_path': '',             # json file of more places for locations, see load_gazetteer()
+  'sent_log_path': 'ny-vax-alert.sent.log',   # --daemon's log of alerts sent, relative to this script
+  'stream_port': 0,                 # stream every alert as server-sent events at http://127.0.0.1:<port>/events, 0 is off
+  'stream_socket_path': ''          # stream every alert as json lines to whoever connects to this unix socket
+}
+
+
+#######################################################################################################
+# one of a config's vaccine_apis, filled in from ny_vaccine_api
+def parse_vaccine_api(key, raw_vaccine_api):
+  vaccine_api = dict(ny_vaccine_api, **raw_vaccine_api)
+  overridden = [setting for setting in ny_feed_settings if setting in raw_vaccine_api and raw_vaccine_api[setting] != ny_vaccine_api.get(setting)]
+  if overridden and 'feed_adapter' not in raw_vaccine_api:
+    vaccine_api['feed_adapter'] = 'fields'
+  if vaccine_api['feed_adapter'] not in feed_adapters:
+    raise ValueError('Unknown feed_adapter for vaccine api ' + key + ': ' + str(vaccine_api['feed_adapter']))
+  if overridden and vaccine_api['feed_adapter'] == 'ny':
+    raise ValueError('The ny feed_adapter of vaccine api ' + key + ' ignores ' + ', '.join(overridden) + ' - use the fields feed_adapter')
+  return vaccine_api
+
+
+#######################################################################################################
+# turn a config, as json decoded from the config file, into the vaccine apis, smtp settings and subscribers
+# we watch with - see ny-vax-alert.example.json for the format
+# returns {'vaccine_apis': {key: vaccine_api}, 'smtp': {...}, 'subscribers': {name: subscriber},
+#          'subscriber_entries': {name: subscriber as in the file}, 'settings': {...}}
+def parse_config(raw_config):
+  settings = dict(default_settings)
+  settings.update((key, value) for key, value in raw_config.items() if key in default_settings)
+  vaccine_apis = {key: parse_vaccine_api(key, vaccine_api) for key, vaccine_api in raw_config.get('vaccine_apis', {'ny': {}}).items()}
+  # a running watcher updates its vaccine_apis in place on reload, so entries compare against copies
+  vaccine_api_entries = {key: dict(vaccine_api) for key, vaccine_api in vaccine_apis.items()}
+  default_vaccine_api_key = next(iter(vaccine_apis))
+  if settings['gazetteer_path']:
+    load_gazetteer(settings['gazetteer_path'])
+
+  subscribers = {}
+  subscriber_entries = {}
+  for entry in raw_config['subscribers']:
+    name = entry['name']
+    if name in subscribers:
+      raise ValueError('Duplicate subscriber name in config: ' + name)
+    subscriber = dict(entry)
+    vaccine_api_key = entry.get('vaccine_api', default_vaccine_api_key)
+    subscriber['vaccine_api'] = vaccine_apis[vaccine_api_key]
+    # alerts go by email to 'to' and/or as a json post to 'webhook'
+    subscriber['msg'] = {'to': entry.get('to'), 'webhook': entry.get('webhook'), 'subject': entry.get('subject', settings['subject']),
+                         'format': entry.get('message_format', settings['message_format'])}
+    if subscriber['msg']['format'] not in message_formats:
+      raise ValueError('Unknown message_format for subscriber ' + name + ': ' + subscriber['msg']['format'])
+    # place names are geocoded here, so a typo shows up when the config loads and workers get coordinates
+    location = get_subscriber_location(subscriber)
+    if location is not None:
+      subscriber['location'] = [location[0], location[1]]
+    subscribers[name] = subscriber
+    # the subscriber's api settings count as part of the subscriber, so edits to them (e.g. its url)
+    # move it over to the api as edited
+    subscriber_entries[name] = dict(entry, vaccine_api=vaccine_api_entries[vaccine_api_key])
+
+  return {
+    'vaccine_apis': vaccine_apis,
+    'smtp': raw_config['smtp'],
+    'subscribers': subscribers,
+    'subscriber_entries': subscriber_entries,
+    'settings': settings
   }
 
-  # start watching for availability
-  user_break = False
-  counter = 0
-  retry = 25  # retry a few times, service may be down now and then
-  desired_provider_available_list = None
-  while (retry > 0 and not user_break):
+
+#######################################################################################################
+# load a json config file
+def load_config(config_path):
+  with open(config_path) as config_file:
+    return parse_config(json.load(config_file))
+
+
+#######################################################################################################
+# sharded watcher - for subscriber counts too big for one process. a coordinator fetches and diffs each
+# vaccine api once, then shares the result with worker processes that each own a shard of the subscribers
+# and do the matching, message rendering and sending for it
+# each new snapshot of an api goes through a shared memory buffer per api, written once and read by every
+# worker, laid out as int64 header [generation, opened count, updates size] followed by the int32 keys
+# of the providers that just opened and then the pickled details of the providers the workers haven't
+# seen like this yet, {key: provider}
+availability_buffer_header = 3
+
+
+#######################################################################################################
+# size of the buffer for an availability snapshot
+def availability_buffer_size(opened_provider_keys, provider_updates):
+  return 8 * availability_buffer_header + 4 * len(opened_provider_keys) + len(provider_updates)
+
+
+#######################################################################################################
+# write an availability snapshot into a shared buffer, provider_updates already pickled
+def write_availability_buffer(buffer, generation, opened_provider_keys, provider_updates):
+  if availability_buffer_size(opened_provider_keys, provider_updates) > buffer.size:
+    raise ValueError('Availability snapshot too big for its shared buffer')
+  header = buffer.buf[:8 * availability_buffer_header].cast('q')
+  opened_start = 8 * availability_buffer_header
+  updates_start = opened_start + 4 * len(opened_provider_keys)
+  buffer.buf[opened_start:updates_start] = array.array('i', opened_provider_keys).tobytes()
+  buffer.buf[updates_start:updates_start + len(provider_updates)] = provider_updates
+  header[0] = generation
+  header[1] = len(opened_provider_keys)
+  header[2] = len(provider_updates)
+  header.release()
+
+
+#######################################################################################################
+# read an availability snapshot from a shared buffer, returns (generation, opened keys, provider updates)
+def read_availability_buffer(buffer):
+  header = buffer.buf[:8 * availability_buffer_header].cast('q')
+  generation, opened_count, updates_size = header[0], header[1], header[2]
+  header.release()
+  opened_start = 8 * availability_buffer_header
+  updates_start = opened_start + 4 * opened_count
+  opened_provider_keys = array.array('i')
+  opened_provider_keys.frombytes(buffer.buf[opened_start:updates_start])
+  return generation, opened_provider_keys, pickle.loads(buffer.buf[updates_start:updates_start + updates_size])
+
+
+#######################################################################################################
+# worker process for one shard of subscribers - waits for the coordinator to announce a new snapshot of
+# an api as (url, name of the api's shared buffer), matches and notifies its subscribers, then reports
+# back (shard, url, subscribers left for that api, metrics since the last report). when told to stop it
+# reports (shard, None, None, metrics) last, once everything queued has been sent
+def shard_worker(shard, vaccine_apis, subscribers, smtp, commands, results):
+  # the coordinator handles ctrl-c and tells us when to stop
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  # a forked worker starts with a copy of the coordinator's metrics, which it already has
+  take_metrics()
+
+  dispatcher = create_notification_dispatcher(smtp)
+  # the webhook sink's session and workers are only worth starting if someone has a webhook
+  router = create_notification_router([dispatcher, create_webhook_sink() if has_webhook_subscribers(subscribers) else None])
+  subscription_indexes = {url: create_subscription_index() for url in vaccine_apis}
+  for subscriber in subscribers:
+    add_subscription(subscription_indexes[subscriber['vaccine_api']['url']], subscriber)
+  buffers = {}    # url -> the api's shared buffer, reattached whenever the coordinator grows it
+  providers = {url: {} for url in vaccine_apis}   # provider key -> provider, as last sent by the coordinator
+
+  while True:
+    command = commands.get()
+    if command is None:
+      break
+    url, buffer_name = command
+    subscription_index = subscription_indexes[url]
     try:
-      desired_provider_available_list = watch_for_vaccine_availability(vaccine_api, desired_provider_id_values, counter)
-      retry = 0
-    except KeyboardInterrupt:
-      print('User break - exiting')
-      user_break = True
-    except BaseException:
-      retry -= 1;
+      if url not in buffers or buffers[url].name != buffer_name:
+        if url in buffers:
+          buffers[url].close()
+        buffers[url] = shared_memory.SharedMemory(name=buffer_name)
+      generation, opened_provider_keys, provider_updates = read_availability_buffer(buffers[url])
+      providers[url].update(provider_updates)
+      opened_provider_list = [providers[url][provider_key] for provider_key in opened_provider_keys]
+
+      with time_stage('match'):
+        matches = match_subscriptions(subscription_index, opened_provider_list)
+      for name, desired_provider_available_list in matches.items():
+        subscriber = subscription_index['subscribers'][name]
+        msg = subscriber['msg']
+        route_notification(router, subscriber, msg['subject'], create_message(desired_provider_available_list, msg.get('format', 'email')), desired_provider_available_list)
+        remove_subscription(subscription_index, name)
+    except Exception:
+      count_metric('shard_errors')
       if __debug__:
         traceback.print_exc()
-  
-  # got something, or an error
-  if desired_provider_available_list:
-    # notify we have an availability match
-    retry = 5   # retry a few times, service may be down now and then
-    while (retry > 0 and not user_break):
+    results.put((shard, url, len(subscription_index['subscribers']), take_metrics()))
+
+  close_notification_router(router)
+  for buffer in buffers.values():
+    buffer.close()
+  results.put((shard, None, None, take_metrics()))
+
+
+#######################################################################################################
+# next report from the shard workers - raises if one of them died, rather than waiting for it forever
+def get_shard_result(results, workers, timeout=1.0):
+  while True:
+    try:
+      return results.get(timeout=timeout)
+    except queue.Empty:
+      for worker in workers:
+        if not worker.is_alive():
+          raise RuntimeError(worker.name + ' exited with code ' + str(worker.exitcode)) from None
+
+
+#######################################################################################################
+# watch for many subscribers with worker_count processes (default one per core), until every subscriber
+# has been notified. smtp holds the sender settings, as for create_notification_dispatcher()
+# buffer_size is the starting size in bytes of each api's shared buffer, which grows as needed
+# the workers' metrics are merged into this process's as they report back
+# returns how many subscribers were notified
+def watch_sharded_for_vaccine_availability(subscribers, smtp, worker_count=None, check_frequency=30.0, buffer_size=1 << 20):
+  worker_count = worker_count or os.cpu_count() or 1
+
+  # shard by name, so a subscriber lands on the same worker every run
+  vaccine_apis = {}
+  shards = [[] for i in range(worker_count)]
+  for subscriber in subscribers:
+    vaccine_apis.setdefault(subscriber['vaccine_api']['url'], subscriber['vaccine_api'])
+    shards[zlib.crc32(subscriber['name'].encode('utf-8')) % worker_count].append(subscriber)
+
+  # subscribers left per api and shard, as reported back by the workers
+  remaining = {url: {} for url in vaccine_apis}
+  for shard, shard_subscribers in enumerate(shards):
+    for subscriber in shard_subscribers:
+      shard_remaining = remaining[subscriber['vaccine_api']['url']]
+      shard_remaining[shard] = shard_remaining.get(shard, 0) + 1
+
+  snapshots = {url: create_availability_snapshot() for url in vaccine_apis}
+  schedules = {url: create_poll_schedule(**dict({'check_frequency': check_frequency}, **vaccine_api.get('poll_schedule', {}))) for url, vaccine_api in vaccine_apis.items()}
+  sent_providers = {url: {} for url in vaccine_apis}
+  next_poll = {url: 0.0 for url in vaccine_apis}
+  generation = 0
+  counter = 0
+  buffers = {}
+  commands = {}
+  workers = {}
+  try:
+    for url in vaccine_apis:
+      buffers[url] = shared_memory.SharedMemory(create=True, size=buffer_size)
+    results = multiprocessing.Queue()
+    for shard, shard_subscribers in enumerate(shards):
+      if shard_subscribers:
+        commands[shard] = multiprocessing.Queue()
+        workers[shard] = multiprocessing.Process(target=shard_worker, name='shard-worker-' + str(shard),
+                                                 args=(shard, vaccine_apis, shard_subscribers, smtp, commands[shard], results))
+        workers[shard].start()
+
+    while True:
+      active_urls = [url for url in vaccine_apis if any(remaining[url].values())]
+      if not active_urls:
+        break
+      url = min(active_urls, key=next_poll.get)
+      time.sleep(max(0.0, next_poll[url] - time.monotonic()))
+      vaccine_api = vaccine_apis[url]
+
+      # just print the count of times we have checked so we know the script is still running
+      counter += 1
+      print(url + ' #' + str(counter))
+
+      poll_started = time.monotonic()
       try:
-        msg['body'] = create_message(desired_provider_available_list, vaccine_api['provider_name_field'])
-        send_message(msg)
-        print(msg['body'])
-        print('Vaccine availability detected, exiting')
-        retry = 0
-      except KeyboardInterrupt:
-        print('User break - exiting')
-        user_break = True
-      except BaseException:
-        retry -= 1;
+        refresh_poll_forecast(schedules[url], vaccine_api)
+        last_updated = vaccine_api_cache.get(url, {}).get('last_updated')
+        with time_stage('poll'):
+          is_fetched, opened_provider_list, closed_provider_list = fetch_availability_changes(vaccine_api, snapshots[url])
+        is_changed = is_poll_changed(url, is_fetched, last_updated)
+        record_poll_result(schedules[url], False, is_changed, len(opened_provider_list) + len(closed_provider_list))
+        count_metric('polls')
+      except Exception:
+        count_metric('poll_errors')
+        record_poll_result(schedules[url], True)
         if __debug__:
           traceback.print_exc()
+        next_poll[url] = time.monotonic() + next_poll_delay(schedules[url], time.monotonic() - poll_started)
+        continue
+
+      if opened_provider_list:
+        # share the snapshot, with details only for providers the workers haven't seen like this yet
+        # pickled once here for every worker, so a provider that can't be pickled fails here too
+        provider_updates = {}
+        for provider in opened_provider_list:
+          if sent_providers[url].get(provider.key) != provider:
+            provider_updates[provider.key] = provider
+        provider_updates = pickle.dumps(provider_updates, pickle.HIGHEST_PROTOCOL)
+        opened_provider_keys = [provider.key for provider in opened_provider_list]
+        size = availability_buffer_size(opened_provider_keys, provider_updates)
+        if size > buffers[url].size:
+          # the workers attach to the new buffer when they see its name in the command
+          size = max(size, 2 * buffers[url].size)
+          buffers[url].close()
+          buffers[url].unlink()
+          buffers[url] = shared_memory.SharedMemory(create=True, size=size)
+        generation += 1
+        write_availability_buffer(buffers[url], generation, opened_provider_keys, provider_updates)
+        for provider in opened_provider_list:
+          sent_providers[url][provider.key] = provider
+
+        # wait for every shard to finish with it before the buffer gets written again
+        active_shards = [shard for shard, count in remaining[url].items() if count]
+        for shard in active_shards:
+          commands[shard].put((url, buffers[url].name))
+        for shard in active_shards:
+          result_shard, result_url, count, worker_metrics = get_shard_result(results, [workers[shard] for shard in active_shards])
+          remaining[result_url][result_shard] = count
+          merge_metrics(worker_metrics)
+
+      next_poll[url] = time.monotonic() + next_poll_delay(schedules[url], time.monotonic() - poll_started)
+  except KeyboardInterrupt:
+    print('User break - exiting')
+  finally:
+    # workers send whatever they still have queued before they stop, then report their last metrics
+    for shard_commands in commands.values():
+      shard_commands.put(None)
+    stopping = {shard: worker for shard, worker in workers.items() if worker.is_alive()}
+    while stopping:
+      try:
+        result_shard, result_url, count, worker_metrics = get_shard_result(results, stopping.values())
+      except RuntimeError:
+        break
+      merge_metrics(worker_metrics)
+      if result_url is None:
+        stopping.pop(result_shard).join()
+    for worker in workers.values():
+      if worker.is_alive():
+        worker.terminate()
+      worker.join()
+    for buffer in buffers.values():
+      buffer.close()
+      buffer.unlink()
+
+  return len(subscribers) - sum(sum(shard_remaining.values()) for shard_remaining in remaining.values())
+
+
+#######################################################################################################
+def main():
+  parser = argparse.ArgumentParser(description='Email when the vaccine sites you want have appointments available')
+  parser.add_argument('config', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ny-vax-alert.json'),
+                      help='json config file with the subscribers to watch for, see ny-vax-alert.example.json - '
+                           'edits are picked up while running. without one, the settings in main() are used')
+  parser.add_argument('--daemon', action='store_true',
+                      help='keep running after alerting, and alert again whenever a site reopens - alerts sent are logged '
+                           'to sent_log_path so a restart never repeats one')
+  parser.add_argument('--once', action='store_true',
+                      help='check every vaccine api once, right away, alert and exit - for cron. alerts sent are logged to '
+                           'sent_log_path, so later runs only alert about sites that opened since')
+  parser.add_argument('--report', action='store_true',
+                      help='print the best times of day to catch each site open, from the history_path of each vaccine api, and exit')
+  args = parser.parse_args()
+
+  config_path = None
+  if os.path.exists(args.config):
+    config_path = args.config
+    config = load_config(config_path)
+  else:
+    config = parse_config({
+      'vaccine_apis': {'ny': ny_vaccine_api},
+
+      # define notification msg parameters and constants
+      'smtp': {
+        'mail_user': 'TBD',       # !!! CHANGE BEFORE USE !!! - who this notification message is from
+        'mail_password': 'TBD',   # !!! CHANGE BEFORE USE !!! - password for email account
+        'smtp_api_url': 'TBD',    # !!! CHANGE BEFORE USE !!! - SMTP url - update code as desired to support other email providers
+        'smtp_api_port': 0        # !!! CHANGE BEFORE USE !!! - SMTP port
+      },
+
+      # everyone to notify - add more subscribers (with their own name, to and provider list) as needed
+      'subscribers': [{
+        'name': 'TBD',            # !!! CHANGE BEFORE USE !!! - unique name for this subscriber
+        'to': 'TBD',              # !!! CHANGE BEFORE USE !!! - who this notification message is to
+        # list of providers that are close to you, by provider ID (see API)
+        'desired_provider_id_values': [1000, 1004, 1019]     # !!! CHANGE BEFORE USE !!! - see providerIDs in expected vaccine api response format below
+      }]
+    })
+  settings = config['settings']
+  subscribers = list(config['subscribers'].values())
+
+  # when sites have tended to open, from the recorded history
+  if args.report:
+    for vaccine_api in config['vaccine_apis'].values():
+      print(vaccine_api['url'])
+      if 'history_path' in vaccine_api:
+        store = get_history_store(vaccine_api)
+        print(format_history_report(history_opening_distribution(store), last_available=history_last_available(store),
+                                    open_rates=history_hourly_open_rate(store)) or 'No openings recorded yet')
+      else:
+        print('No history recorded - set history_path for this vaccine api')
+    return
+
+  # pipeline metrics
+  if settings['metrics_port']:
+    start_metrics_server(settings['metrics_port'])
+  if settings['metrics_dump_frequency']:
+    start_metrics_dump(settings['metrics_dump_frequency'])
+
+  # shard the subscribers over worker processes when there are too many for one
+  # the daemon keeps its sent log in this process, so it always watches in one, and a one-shot check has no time to shard
+  if settings['worker_count'] and not args.daemon and not args.once:
+    notified_count = watch_sharded_for_vaccine_availability(subscribers, config['smtp'], settings['worker_count'], settings['check_frequency'])
+    print(format_metrics_summary())
+    if notified_count:
+      print('Vaccine availability detected, exiting')
+    else:
+      print('No vaccine availability detected, exiting')
+    return
+
+  # notify a subscriber we have an availability match - the router hands alerts to the smtp dispatcher,
+  # webhooks and the local stream, which all send in the background, so none of them holds up polling
+  dispatcher = create_notification_dispatcher(config['smtp'])
+  stream_sink = None
+  if settings['stream_port'] or settings['stream_socket_path']:
+    stream_sink = start_notification_stream(settings['stream_socket_path'] or None, settings['stream_port'] or None)
+  router = create_notification_router([dispatcher, create_webhook_sink() if has_webhook_subscribers(subscribers) else None, stream_sink])
+  notified_subscribers = []
+  sent_log = None
+  snapshots = None
+  if args.daemon or args.once:
+    sent_log = open_sent_log(os.path.join(os.path.dirname(os.path.abspath(__file__)), settings['sent_log_path']))
+    snapshots = restore_availability_snapshots(sent_log)
+
+  def notify_subscriber(subscriber, desired_provider_available_list):
+    # with a sent log, skip openings we already alerted this subscriber about, and log the rest once delivered
+    on_delivered = None
+    if sent_log is not None:
+      url = subscriber['vaccine_api']['url']
+      desired_provider_available_list = [provider for provider in desired_provider_available_list if not is_notification_sent(sent_log, subscriber['name'], url, provider)]
+      if not desired_provider_available_list:
+        return False
+      record_notification_queued(sent_log, subscriber['name'], url, desired_provider_available_list)
+
+      def on_delivered(notification, is_delivered):
+        record_notification_delivered(sent_log, subscriber['name'], url, desired_provider_available_list, is_delivered)
+
+    msg = subscriber['msg']
+    body = create_message(desired_provider_available_list, msg.get('format', 'email'))
+    route_notification(router, subscriber, msg['subject'], body, desired_provider_available_list, on_delivered)
+    print(body)
+    notified_subscribers.append(subscriber)
+    # done with this subscriber, unless we are a daemon and keep watching for the next opening
+    return not args.daemon
+
+  # a closed site alerts again when it reopens
+  def close_providers(vaccine_api, desired_provider_closed_list):
+    record_providers_closed(sent_log, vaccine_api['url'], desired_provider_closed_list)
+
+  # new smtp settings take effect for the next connection the dispatcher opens, and the first webhook
+  # added to the config starts the webhook sink
+  def reload_settings(new_config):
+    dispatcher['smtp'] = new_config['smtp']
+    if has_webhook_subscribers(new_config['subscribers'].values()) and not any(sink['name'] == 'webhook' for sink in router['sinks']):
+      router['sinks'].append(create_webhook_sink())
+
+  async def on_match(subscriber, desired_provider_available_list):
+    return notify_subscriber(subscriber, desired_provider_available_list)
+
+  async def on_close(vaccine_api, desired_provider_closed_list):
+    close_providers(vaccine_api, desired_provider_closed_list)
+
+  # alerts that didn't get through are tried again on the api's next poll, if their sites are still open
+  def take_retries(url):
+    return take_failed_notifications(sent_log, url)
+
+  # check once, or start watching for availability
+  try:
+    if args.once:
+      check_all_for_vaccine_availability(subscribers, notify_subscriber, close_providers, snapshots)
+    else:
+      asyncio.run(watch_all_for_vaccine_availability(subscribers, on_match, on_close if sent_log else None, check_frequency=settings['check_frequency'],
+                                                     max_concurrency=settings['max_concurrency'], config_path=config_path, config=config, on_reload=reload_settings,
+                                                     snapshots=snapshots, take_retries=take_retries if sent_log else None))
+  except KeyboardInterrupt:
+    print('User break - exiting')
+
+  # let anything still queued go out before we exit
+  close_notification_router(router)
+  if sent_log is not None:
+    close_sent_log(sent_log)
+  print(format_metrics_summary())
+
+  if notified_subscribers:
+    print('Vaccine availability detected, exiting')
   else:
     print('No vaccine availability detected, exiting')
 
 
 #######################################################################################################
 # stay safe!
-main()
+if __name__ == '__main__':
+  main()
 
 
 #######################################################################################################